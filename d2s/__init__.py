@@ -1 +1,6 @@
-from .graph_builder import GraphBuilder
\ No newline at end of file
+def __getattr__(name):
+    # GraphBuilder loads rdflib, it is only imported when accessed
+    if name == 'GraphBuilder':
+        from .graph_builder import GraphBuilder
+        return GraphBuilder
+    raise AttributeError("module 'd2s' has no attribute '" + name + "'")
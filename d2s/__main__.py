@@ -5,17 +5,26 @@ import shutil
 import click
 import datetime
 
-from d2s.generate_metadata import create_dataset_prompt, generate_hcls_from_sparql
-from d2s.utils import new_dataset, get_config, init_folder, get_base_dir, init_d2s_java
-from d2s.sparql_operations import sparql_insert_files, java_upload_files
-from d2s.process_datasets import process_datasets_metadata
-from d2s.generate_shacl import generate_shacl
-from rdflib import Graph
+# Only the default values of the options are imported here, the modules of each command (and their dependencies:
+# rdflib, pandas, git, requests...) are imported when the command runs, to start d2s faster.
+# The modules of the package follow the same rule for the heavy dependencies only used by some functions
+from d2s.defaults import DEFAULT_ISQL, METADATA_JOURNAL_SUFFIX, STREAM_FORMATS, SLOWEST_QUERIES_COUNT, SPARQL_CLIENT_DEFAULTS, SNAPSHOTS_KEEP
 
 @click.group()
-def cli():
+@click.option(
+    '--sparql-timeout', default=None, type=int, envvar='D2S_SPARQL_TIMEOUT',
+    help='Seconds to wait for the response of a SPARQL endpoint. Default: ' + str(SPARQL_CLIENT_DEFAULTS['read_timeout']))
+@click.option(
+    '--sparql-retries', default=None, type=int, envvar='D2S_SPARQL_RETRIES',
+    help='Number of retries of SPARQL requests failing with a connection or 5xx error, with an exponential backoff. Default: ' + str(SPARQL_CLIENT_DEFAULTS['retries']))
+@click.option(
+    '--sparql-connections', default=None, type=int, envvar='D2S_SPARQL_CONNECTIONS',
+    help='Maximum number of concurrent requests sent to each SPARQL endpoint. Default: ' + str(SPARQL_CLIENT_DEFAULTS['max_connections']))
+def cli(sparql_timeout, sparql_retries, sparql_connections):
     """d2s Command Line Interface"""
-    pass
+    if sparql_timeout is not None or sparql_retries is not None or sparql_connections is not None:
+        from d2s.sparql_client import configure_sparql_client
+        configure_sparql_client(read_timeout=sparql_timeout, retries=sparql_retries, max_connections=sparql_connections)
 
 # @click.argument('projectname', nargs=1)
 # @click.pass_context
@@ -23,11 +32,13 @@ def cli():
 @cli.command()
 def init():
     """Initialize a project in the provided folder name"""
+    from d2s.utils import init_folder
     init_folder()
 
 @cli.command()
 def config():
     """Show the project configuration"""
+    from d2s.utils import get_config
     get_config()
 
 
@@ -39,6 +50,7 @@ def new():
 @new.command()
 def dataset():
     """Create a new folder to map data from a template"""
+    from d2s.utils import new_dataset
     new_dataset()
 
 
@@ -76,7 +88,58 @@ def metadata():
 @click.option(
     '--create-dataset/--analyze-only', default=False,
     help='Prompt questions to generate the dataset metadata and analyze the endpoint (default), or only analyze')
-def analyze(sparql_endpoint, dataset_uri, output, metadata_type, graph, create_dataset):
+@click.option(
+    '-c', '--concurrency', default=1,
+    help='Number of SPARQL queries sent in parallel to the endpoint. Default: 1')
+@click.option(
+    '--approximate/--exact', default=False,
+    help='Page the triples out of the endpoint and estimate distinct counts with HyperLogLog sketches, instead of running COUNT(DISTINCT) queries. Default: --exact')
+@click.option(
+    '-e', '--error', default=0.02,
+    help='Relative standard error of the distinct counts estimated with --approximate. Default: 0.02')
+@click.option(
+    '-s', '--split', default='auto',
+    help='Split the aggregation queries (with GROUP BY) in smaller queries: none, per predicate, per class, or by page of groups. auto splits per predicate the queries that fail. Default: auto')
+@click.option(
+    '--page-size', default=10000,
+    help='Number of triples fetched per query with --approximate, or of groups with --split page. Default: 10000')
+@click.option(
+    '--cache/--no-cache', default=True,
+    help='Reuse the results cached in ~/.local/share/d2s for the graphs which did not change (same modification date or number of triples). Default: --cache')
+@click.option(
+    '--refresh', is_flag=True, default=False,
+    help='Run all queries again and refresh the cached results')
+@click.option(
+    '--cache-size', default=100,
+    help='Maximum size of the results cache in MB, the least recently used results are evicted. Default: 100')
+@click.option(
+    '--incremental', is_flag=True, default=False,
+    help='Only analyze the graphs which are new or changed since the last run, and update their metadata in the output file')
+@click.option(
+    '--graphs-source', default='query',
+    help='How to list the graphs: query (generic SPARQL query scanning all quads), virtuoso (DB.DBA.SPARQL_SELECT_KNOWN_GRAPHS with isql), rdf4j (GraphDB/RDF4J repository API), or file:<path> (one graph per line). Default: query')
+@click.option(
+    '--graphs-filter', default=None,
+    help='Only analyze the graphs matching this regex, e.g. "^http://bio2rdf.org" (default for bio2rdf metadata)')
+@click.option(
+    '--isql', default=DEFAULT_ISQL,
+    help='isql command used by --graphs-source virtuoso, e.g. "docker exec -i virtuoso isql-v". The dba password is read from DBA_PASSWORD. Default: ' + DEFAULT_ISQL)
+@click.option(
+    '--stream', default=None, type=click.Choice(STREAM_FORMATS),
+    help='Write the results of each query to the output file in N-Triples (nt) or N-Quads (nq, in the graph analyzed) as soon as it completes, instead of keeping all metadata in memory')
+@click.option(
+    '--per-graph', is_flag=True, default=False,
+    help='With --stream, write the metadata of each graph in a separate file in the output directory')
+@click.option(
+    '--resume', is_flag=True, default=False,
+    help='Resume an analysis which crashed or timed out: the queries completed, recorded in a journal next to the output file, are not run again')
+@click.option(
+    '--query-log', default=None,
+    help='Log the wall time, bytes received and triples parsed of each query to this JSON lines file, and print the slowest queries')
+def analyze(sparql_endpoint, dataset_uri, output, metadata_type, graph, create_dataset, concurrency, approximate, error, split, page_size, cache, refresh, cache_size, incremental,
+        graphs_source, graphs_filter, isql, stream, per_graph, resume, query_log):
+    from rdflib import Graph
+    from d2s.generate_metadata import compute_hcls_from_sparql, generate_approximate_hcls_from_sparql, update_hcls_from_sparql
 
     # if not dataset_uri:
     #     dataset_uri = 'https://w3id.org/d2s/distribution/default'
@@ -84,7 +147,72 @@ def analyze(sparql_endpoint, dataset_uri, output, metadata_type, graph, create_d
     g = Graph()
     # if create_dataset:
     #     g, metadata_answers = create_dataset_prompt(dataset_uri, g)
-    g = generate_hcls_from_sparql(sparql_endpoint, dataset_uri, metadata_type, graph, g, create_dataset)
+    # The completed queries are recorded in a journal next to the output file, to resume the analysis
+    journal_file = output + METADATA_JOURNAL_SUFFIX if output else None
+    if resume and not journal_file:
+        raise Exception("--resume requires the output file (-o) of the analysis to resume")
+    stream_output = None
+    if stream:
+        if not output or create_dataset or incremental:
+            raise Exception("--stream requires an output file, or directory with --per-graph (-o), and can not be used with --create-dataset or --incremental")
+        stream_output = output
+    if incremental:
+        if not output or metadata_type != 'hcls':
+            raise Exception("--incremental requires an output file to update (-o), and is only available for hcls metadata")
+        update_hcls_from_sparql(sparql_endpoint, output, graph, concurrency, graphs_source, graphs_filter, isql,
+            split=split, page_size=page_size, cache=cache, refresh=refresh, cache_size=cache_size * 1024 * 1024,
+            journal_file=journal_file, resume=resume, query_log=query_log)
+        print(f"Metadata updated in {output} 📝")
+        return
+    if approximate:
+        if metadata_type != 'hcls':
+            raise Exception("--approximate is only available for hcls metadata")
+        g = generate_approximate_hcls_from_sparql(sparql_endpoint, graph, g, error, page_size, graphs_source, graphs_filter, isql,
+            stream_output, stream, per_graph, journal_file, resume)
+    else:
+        # The metadata of the queries which succeeded is still written, the failed queries are retried with --resume
+        g, failed_graphs = compute_hcls_from_sparql(sparql_endpoint, dataset_uri, metadata_type, graph, g, create_dataset, concurrency, split, page_size,
+            cache, refresh, cache_size * 1024 * 1024, graphs_source, graphs_filter, isql, stream_output, stream, per_graph,
+            journal_file, resume, query_log)
+    if stream_output:
+        print(f"Metadata streamed to {output} 📝")
+    elif output:
+        g.serialize(destination=output, format='turtle')
+        print(f"Metadata stored to {output} 📝")
+    else:
+        print(g.serialize(format='turtle'))
+
+
+@metadata.command(help='Print the queries which took the most time from a log generated with analyze --query-log')
+@click.argument('query_log')
+@click.option(
+    '-n', '--count', default=SLOWEST_QUERIES_COUNT,
+    help='Number of queries to show. Default: ' + str(SLOWEST_QUERIES_COUNT))
+def timings(query_log, count):
+    from d2s.query_log import read_query_log, print_slowest_queries
+    print_slowest_queries(read_query_log(query_log), count)
+
+
+@metadata.command(name='analyze-file', help='Generate HCLS descriptive metadata for N-Triples files, in a single pass without loading them in a triplestore')
+@click.argument('rdf_files', nargs=-1, required=True)
+@click.option(
+    '-u', '--dataset-uri', default='https://w3id.org/d2s/distribution/default',
+    help='URI of the dataset distribution to describe')
+@click.option(
+    '-o', '--output', default='',
+    help='Write RDF to output file')
+@click.option(
+    '--approximate/--exact', default=False,
+    help='Estimate distinct counts with HyperLogLog sketches, to use a fixed memory for large files. Default: --exact')
+@click.option(
+    '-e', '--error', default=0.02,
+    help='Relative standard error of the distinct counts estimated with --approximate. Default: 0.02')
+def analyze_file(rdf_files, dataset_uri, output, approximate, error):
+    from d2s.hcls_stats import generate_hcls_from_files, generate_approximate_hcls_from_files
+    if approximate:
+        g = generate_approximate_hcls_from_files(rdf_files, dataset_uri, error)
+    else:
+        g = generate_hcls_from_files(rdf_files, dataset_uri)
     if output:
         g.serialize(destination=output, format='turtle')
         print(f"Metadata stored to {output} 📝")
@@ -119,8 +247,29 @@ def analyze(sparql_endpoint, dataset_uri, output, metadata_type, graph, create_d
 @click.option(
     '--rmlstreamer/--local', default=False,
     help='Activate the generation of a HTML report to explore downloaded tabular files')
-def run(input_file, dryrun, staging, sample, report, memory, rmlstreamer):
-    process_datasets_metadata(input_file, dryrun, staging, sample, report, memory, rmlstreamer)
+@click.option(
+    '-j', '--jobs', default=1,
+    help='Number of RML mappings run in parallel with rmlmapper-java or RocketRML, the memory is split between them. Default: 1')
+@click.option(
+    '-p', '--partitions', default=1,
+    help='Split large CSV/TSV inputs (>100MB) in partitions mapped in parallel by -j jobs, for mappings with a single source and ntriples output. Default: 1')
+@click.option(
+    '--gzip/--no-gzip', default=False,
+    help='Compress with gzip the N-Triples file merged from multiple mappings outputs. Default: --no-gzip')
+@click.option(
+    '--delta/--full', default=False,
+    help='If --publish enabled: only publish the N-Triples statements added or removed since the last publication with SPARQL updates, or upload the whole file (default)')
+@click.option(
+    '--keep-snapshots', default=SNAPSHOTS_KEEP,
+    help='Number of versions of the N-Triples output published kept in .d2s-snapshots, see d2s snapshot. Use 0 to disable. Default: ' + str(SNAPSHOTS_KEEP))
+@click.option(
+    '--local-stats', is_flag=True, default=False,
+    help='If --publish enabled: estimate the HCLS metadata from the N-Triples output file with HyperLogLog sketches, instead of querying the published graph')
+def run(input_file, dryrun, staging, sample, report, memory, rmlstreamer, jobs, partitions, gzip, delta, keep_snapshots, local_stats):
+    if delta and keep_snapshots < 1:
+        raise click.UsageError('--delta compares the output to the snapshot last published, it can not be used with --keep-snapshots 0')
+    from d2s.process_datasets import process_datasets_metadata
+    process_datasets_metadata(input_file, dryrun, staging, sample, report, memory, rmlstreamer, jobs, partitions, gzip, delta, keep_snapshots, local_stats)
     # if output:
     #     g.serialize(destination=output, format='turtle')
     #     print("Metadata stored to " + output + ' 📝')
@@ -130,10 +279,70 @@ def run(input_file, dryrun, staging, sample, report, memory, rmlstreamer):
 
 
 
+@cli.group()
+def snapshot():
+    """Compare and roll back the versions of the N-Triples produced by d2s run, stored in .d2s-snapshots"""
+    pass
+
+@snapshot.command(name='list', help='List the snapshots of a dataset, from the oldest to the latest')
+@click.argument('dataset_id')
+def list_snapshots(dataset_id):
+    from d2s.snapshot_store import load_snapshots_index
+    index = load_snapshots_index(dataset_id)
+    for snapshot in index['snapshots']:
+        published = '  📰 published' if snapshot['id'] == index['published'] else ''
+        print(f"{snapshot['id']}  {snapshot['statements']:>12} statements  {snapshot['size']:>12} bytes{published}")
+
+@snapshot.command(help='Print the statements removed (-) and added (+) between 2 snapshots of a dataset, use "published" for the snapshot last published')
+@click.argument('dataset_id')
+@click.argument('old_snapshot')
+@click.argument('new_snapshot', required=False)
+@click.option(
+    '--count/--statements', default=False,
+    help='Only print the number of statements removed and added')
+def diff(dataset_id, old_snapshot, new_snapshot, count):
+    from d2s.snapshot_store import diff_snapshots
+    changes_count = { '-': 0, '+': 0 }
+    for change, statement in diff_snapshots(dataset_id, old_snapshot, new_snapshot):
+        changes_count[change] += 1
+        if not count:
+            print(change + ' ' + statement)
+    print('🔀 ' + str(changes_count['-']) + ' statements removed and ' + str(changes_count['+']) + ' added', file=sys.stderr)
+
+@snapshot.command(help='Roll back to a snapshot of a dataset: restore it to the output folder, and publish only its changes with --publish')
+@click.argument('dataset_id')
+@click.argument('snapshot_id')
+@click.option(
+    '-o', '--output', default=None,
+    help='File where the snapshot is restored. Default: output/DATASET_ID.nt')
+@click.option(
+    '--publish', default=None,
+    help='URL of the SPARQL update endpoint where the snapshot is published, only sending the changes since the snapshot last published')
+@click.option(
+    '-g', '--graph', default=None,
+    help='Graph of the dataset in the SPARQL endpoint, required with --publish')
+@click.option(
+    '-u', '--username', default='dba',
+    help='Username for the SPARQL endpoint')
+@click.option(
+    '-p', '--password', default='dba',
+    help='Password for the SPARQL endpoint')
+def rollback(dataset_id, snapshot_id, output, publish, graph, username, password):
+    from d2s.snapshot_store import restore_snapshot, publish_snapshot
+    restore_snapshot(dataset_id, snapshot_id, output or 'output/' + dataset_id + '.nt')
+    if publish:
+        if not graph:
+            raise click.UsageError('The graph of the dataset is required to publish a snapshot, use -g')
+        publish_snapshot(dataset_id, snapshot_id, publish, username, password, graph)
+
+
+
+
 # TODO: new command to automatically generate SHACL from a RDF snippet
 @cli.command(help='Generate SHACL shapes from a RDF metadata')
 @click.argument('rdf_file')
 def shacl(rdf_file):
+    from d2s.generate_shacl import generate_shacl
     generate_shacl(rdf_file)
 
 
@@ -159,9 +368,40 @@ def sparql():
     help='Graph where to load the RDF')
 @click.option(
     '--chunks-size', default='1000',
-    help='Number of statements per chunks inserted. Use -1 to load all in one shot.')
-def insert(file_pattern, sparql_endpoint, username, password, graph, chunks_size):
-    sparql_insert_files(file_pattern, sparql_endpoint, username, password, graph, chunks_size)
+    help='Number of statements per chunks inserted for .nt and .nq files, which are streamed. Use -1 to load all in one shot. Files with blank nodes are always loaded in one shot, since blank nodes are not shared between chunks.')
+@click.option(
+    '-w', '--workers', default=1,
+    help='Number of files parsed and uploaded concurrently (also limited by --sparql-connections). Default: 1')
+def insert(file_pattern, sparql_endpoint, username, password, graph, chunks_size, workers):
+    from d2s.sparql_operations import sparql_insert_files
+    failed_files = sparql_insert_files(file_pattern, sparql_endpoint, username, password, graph, chunks_size, workers)
+    if failed_files:
+        sys.exit(1)
+
+@sparql.command(help='Sync the subjects described in RDF files with their triples in a SPARQL endpoint, only deleting and inserting the triples which changed')
+@click.argument('file_pattern')
+@click.argument('sparql_endpoint')
+@click.option(
+    '-u', '--username', default='dba',
+    help='Username for the SPARQL endpoint')
+@click.option(
+    '-p', '--password', default='dba',
+    help='Password for the SPARQL endpoint')
+@click.option(
+    '-g', '--graph', default=None,
+    help='Graph where the subjects are synced')
+@click.option(
+    '--update-endpoint', default=None,
+    help='URL of the SPARQL update endpoint, if different from the SPARQL endpoint (e.g. /statements for GraphDB)')
+@click.option(
+    '--depth', default=1,
+    help='Levels of blank nodes included in the description of a subject. Default: 1')
+@click.option(
+    '--batch-size', default=100,
+    help='Number of subjects synced per request. Default: 100')
+def sync(file_pattern, sparql_endpoint, username, password, graph, update_endpoint, depth, batch_size):
+    from d2s.sparql_operations import sparql_sync_files
+    sparql_sync_files(file_pattern, sparql_endpoint, username, password, graph, depth, batch_size, update_endpoint)
 
 @sparql.command(help='Upload RDF files to a SPARQL endpoint using Java RDF4J (java installed required)')
 @click.argument('file_pattern')
@@ -176,6 +416,7 @@ def insert(file_pattern, sparql_endpoint, username, password, graph, chunks_size
     '-g', '--graph', default='',
     help='Graph where to load the RDF')
 def upload(file_pattern, sparql_endpoint, username, password, graph):
+    from d2s.sparql_operations import java_upload_files
     java_upload_files(file_pattern, sparql_endpoint, username, password, graph)
 
 
@@ -252,6 +493,7 @@ def chmod777(path):
     help='Run in parallel, depends on Task Slots availables')
 def rml(dataset, detached, yarrrml, mapper, openshift, parallelism):
     """Run RML Streamer"""
+    from d2s.utils import get_base_dir, init_d2s_java
     if (detached):
         detached_arg = '-d'
     else:
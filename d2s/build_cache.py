@@ -0,0 +1,102 @@
+import os
+import json
+import shutil
+import hashlib
+from rdflib import Graph, Literal, URIRef
+
+# Build cache of d2s run, stored in the dataset folder
+BUILD_CACHE_DIR = '.d2s-build'
+BUILD_CACHE_FILE = BUILD_CACHE_DIR + '/manifest.json'
+# Outputs of the mappings are moved here after being concatenated, to be reused by the next run
+CACHED_OUTPUTS_DIR = BUILD_CACHE_DIR + '/output'
+
+RML_SOURCE = URIRef('http://semweb.mmlab.be/ns/rml#source')
+
+
+def load_build_cache(cache_file=BUILD_CACHE_FILE):
+    """Load the build cache manifest, with the keys of the mappings and the hashes of the files"""
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            return json.load(f)
+    return { 'mappings': {}, 'files': {}, 'merged': None }
+
+
+def save_build_cache(build_cache, cache_file=BUILD_CACHE_FILE):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump(build_cache, f, indent=2, sort_keys=True)
+    os.replace(cache_file + '.tmp', cache_file)
+
+
+def file_sha256(file_path, chunk_size=1024 * 1024):
+    """Compute the SHA-256 of a file, reading it by chunks"""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_file_hash(build_cache, file_path):
+    """Get the SHA-256 of a file, only hashing it again if its size or modification time changed
+    :return: the hash, or None if the file does not exist
+    """
+    if not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    cached_file = build_cache['files'].get(file_path)
+    if cached_file and cached_file['size'] == stat.st_size and cached_file['mtime'] == stat.st_mtime_ns:
+        return cached_file['sha256']
+    sha256 = file_sha256(file_path)
+    build_cache['files'][file_path] = { 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': sha256 }
+    return sha256
+
+
+def get_rml_sources(rml_file):
+    """List the files used as rml:source in a RML mapping file"""
+    g = Graph()
+    g.parse(rml_file, format='turtle')
+    return sorted(set(str(source) for source in g.objects(None, RML_SOURCE) if isinstance(source, Literal)))
+
+
+def get_mapping_cache_key(build_cache, yarrrml_file, rml_file, functions_file, data_dir='data', **params):
+    """Compute the key of a mapping run from the hashes of the YARRRML file, the generated RML,
+    the functions file and the input files used by the mapping, and the params of the run"""
+    inputs = {}
+    for source in get_rml_sources(rml_file):
+        inputs[source] = get_file_hash(build_cache, os.path.join(data_dir, source))
+    key = {
+        'yarrrml': get_file_hash(build_cache, yarrrml_file),
+        'rml': get_file_hash(build_cache, rml_file),
+        'functions': get_file_hash(build_cache, functions_file),
+        'inputs': inputs,
+        'params': params,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_merged_cache_key(mapping_keys):
+    """Key of the concatenated output, None if one of the mappings outputs can not be cached"""
+    if not mapping_keys or None in mapping_keys:
+        return None
+    return hashlib.sha256(json.dumps(sorted(mapping_keys)).encode('utf-8')).hexdigest()
+
+
+def cached_output_exists(output_file):
+    """Check if the output of a mapping is still in the output folder, or has been moved to the build cache"""
+    return os.path.exists(output_file) or os.path.exists(os.path.join(CACHED_OUTPUTS_DIR, os.path.basename(output_file)))
+
+
+def restore_cached_outputs(output_files):
+    """Move the mappings outputs kept in the build cache back to the output folder, if they are not there already"""
+    for output_file in output_files:
+        cached_file = os.path.join(CACHED_OUTPUTS_DIR, os.path.basename(output_file))
+        if os.path.exists(cached_file) and not os.path.exists(output_file):
+            os.replace(cached_file, output_file)
+
+
+def store_cached_outputs(output_files):
+    """Move mappings outputs to the build cache, instead of deleting them once concatenated"""
+    os.makedirs(CACHED_OUTPUTS_DIR, exist_ok=True)
+    for output_file in output_files:
+        shutil.move(output_file, os.path.join(CACHED_OUTPUTS_DIR, os.path.basename(output_file)))
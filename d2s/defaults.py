@@ -0,0 +1,28 @@
+"""Default values of the d2s command line options, without any dependency, so the options are defined
+without importing the modules of the commands. The modules using them import them from here"""
+
+# isql command used to list the graphs of a Virtuoso triplestore, see d2s.graph_discovery
+DEFAULT_ISQL = 'isql-v localhost:1111'
+
+# Default settings of the SPARQL client, changed for all commands with the d2s options, see d2s.sparql_client
+SPARQL_CLIENT_DEFAULTS = {
+    # Seconds to wait to connect, and to wait for the response
+    'connect_timeout': 10,
+    'read_timeout': 600,
+    'retries': 3,
+    'backoff_factor': 1,
+    # Maximum number of concurrent requests sent to each endpoint
+    'max_connections': 8,
+}
+
+# Journal of the completed queries, next to the metadata output file, in JSON lines
+METADATA_JOURNAL_SUFFIX = '.d2s-journal.jsonl'
+
+# Formats to stream RDF to a file line by line: N-Triples, or N-Quads with the graph of each statement
+STREAM_FORMATS = ['nt', 'nq']
+
+# Number of queries shown in the summary of the slowest queries
+SLOWEST_QUERIES_COUNT = 10
+
+# Default number of snapshots kept per dataset, the oldest are removed, but never the published one
+SNAPSHOTS_KEEP = 10
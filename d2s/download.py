@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from urllib.parse import urlparse
+from dateutil.parser import parse as parsedate
+
+from d2s.http_client import request_with_retry
+
+# Manifest of the files downloaded in the data folder, with their ETag, Last-Modified, size and SHA-256
+DOWNLOAD_CACHE_FILE = '.d2s-cache.json'
+# Seconds to wait for the connection, and between 2 chunks of the body
+DOWNLOAD_TIMEOUT = (10, 300)
+
+
+def get_download_filename(ddl_url):
+    """Name of the file downloaded from an URL, as wget would name it"""
+    return os.path.basename(urlparse(ddl_url).path) or 'index.html'
+
+
+def load_download_cache(cache_file=DOWNLOAD_CACHE_FILE):
+    """Load the download cache manifest, indexed by download URL"""
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            return json.load(f)
+    return {}
+
+
+def save_download_cache(cache, cache_file=DOWNLOAD_CACHE_FILE):
+    """Write the download cache manifest, through a temporary file to never leave a corrupted manifest"""
+    with open(cache_file + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(cache_file + '.tmp', cache_file)
+
+
+def get_conditional_headers(cache_entry, processed_filename):
+    """Build the If-None-Match and If-Modified-Since headers to only get a file if it changed
+    If the file is not in the cache, fallback to the modification time of the existing processed file"""
+    headers = {}
+    if not os.path.exists(processed_filename):
+        return headers
+    if cache_entry:
+        if cache_entry.get('etag'):
+            headers['If-None-Match'] = cache_entry['etag']
+        if cache_entry.get('lastModified'):
+            headers['If-Modified-Since'] = cache_entry['lastModified']
+    else:
+        headers['If-Modified-Since'] = formatdate(os.path.getmtime(processed_filename), usegmt=True)
+    return headers
+
+
+def stream_download(ddl_url, filename, headers={}, chunk_size=1024 * 1024, pool_size=10):
+    """Stream the body of an URL to filename.part, without loading it in memory, and hash it on the fly,
+    with the pooled session of d2s.http_client
+    :return: the response, the number of bytes and the SHA-256 of the body, or None if not modified (304)
+    """
+    tmp_filename = filename + '.part'
+    downloaded_bytes = 0
+    sha256 = hashlib.sha256()
+    with request_with_retry('GET', ddl_url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT, pool_size=pool_size) as r:
+        if r.status_code == 304:
+            return r, None, None
+        r.raise_for_status()
+        with open(tmp_filename, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+                sha256.update(chunk)
+                downloaded_bytes += len(chunk)
+    return r, downloaded_bytes, sha256.hexdigest()
+
+
+def check_and_download_file(ddl_file, cache_entry=None, pool_size=10):
+    """Download a file to the current folder with a conditional GET, if it changed since the last download
+    Files with a downloadScript are only checked with a conditional HEAD, the script is run afterward by the caller
+    :return: the ddl_file dict, with skipDownload and the new cacheEntry set
+    """
+    ddl_url = ddl_file['downloadUrl']
+    processed_filename = ddl_file['processedFilename']
+    headers = get_conditional_headers(cache_entry, processed_filename)
+    ddl_file['skipDownload'] = True
+    ddl_file['cacheEntry'] = cache_entry
+
+    if 'downloadScript' in ddl_file:
+        print('🔎 Checking if the file at ' + ddl_url + ' changed')
+        r = request_with_retry('HEAD', ddl_url, headers=headers, timeout=DOWNLOAD_TIMEOUT, pool_size=pool_size)
+        if r.status_code != 304:
+            r.raise_for_status()
+        if r.status_code == 304:
+            print('⏩️ The remote file ' + ddl_url + ' did not change. Skipping download.')
+            return ddl_file
+        ddl_file['skipDownload'] = False
+        ddl_file['cacheEntry'] = {
+            'etag': r.headers.get('etag'),
+            'lastModified': r.headers.get('last-modified'),
+            'size': int(r.headers['content-length']) if 'content-length' in r.headers else None,
+            'sha256': None,
+        }
+        print('📥 The remote file ' + ddl_url + ' changed, or is not in the cache. Downloading it with the download script.')
+        return ddl_file
+
+    print('🔎 Downloading ' + ddl_url + ' if it changed')
+    filename = get_download_filename(ddl_url)
+    start_time = time.time()
+    r, downloaded_bytes, sha256 = stream_download(ddl_url, filename, headers, pool_size=pool_size)
+    run_time = max(time.time() - start_time, 0.001)
+    if sha256 is None:
+        print('⏩️ The remote file ' + ddl_url + ' did not change (304). Skipping download.')
+        return ddl_file
+
+    if 'last-modified' in r.headers.keys():
+        ddl_file['lastModified'] = parsedate(r.headers['last-modified'])
+    ddl_file['cacheEntry'] = {
+        'etag': r.headers.get('etag'),
+        'lastModified': r.headers.get('last-modified'),
+        'size': downloaded_bytes,
+        'sha256': sha256,
+    }
+    if cache_entry and cache_entry.get('sha256') == sha256 and os.path.exists(processed_filename):
+        # Server without validators: same content, keep the existing (maybe post-processed) file
+        os.remove(filename + '.part')
+        print('⏩️ The remote file ' + ddl_url + ' has the same SHA-256 as the last download. Skipping post processing.')
+        return ddl_file
+
+    os.replace(filename + '.part', filename)
+    # Keep the remote modification time, like wget -N
+    if 'lastModified' in ddl_file.keys():
+        last_modified = ddl_file['lastModified'].timestamp()
+        os.utime(filename, (last_modified, last_modified))
+    ddl_file['skipDownload'] = False
+    print('💾 Downloaded ' + filename + ': ' + str(round(downloaded_bytes / 1000000, 2)) + ' MB in '
+        + str(round(run_time, 2)) + 's (' + str(round(downloaded_bytes / 1000000 / run_time, 2)) + ' MB/s)')
+    return ddl_file
+
+
+def download_files(download_file_list, download_workers=4, cache_file=DOWNLOAD_CACHE_FILE):
+    """Check and download the files of a dataset in parallel, in the current folder
+    The download cache manifest is updated once all files have been processed, also when some downloads failed,
+    so the files downloaded are not downloaded again by the next run
+    :return: the list of files, in the same order, with skipDownload set
+    """
+    cache = load_download_cache(cache_file)
+    download_workers = max(1, int(download_workers))
+    failures = []
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        futures = [executor.submit(check_and_download_file, ddl_file, cache.get(ddl_file['downloadUrl']), download_workers)
+            for ddl_file in download_file_list]
+        for ddl_file, future in zip(download_file_list, futures):
+            try:
+                future.result()
+            except Exception as e:
+                print('❌ Failed to download ' + ddl_file['downloadUrl'] + ': ' + str(e))
+                failures.append(ddl_file['downloadUrl'] + ': ' + str(e))
+                continue
+            if ddl_file['cacheEntry']:
+                cache[ddl_file['downloadUrl']] = ddl_file['cacheEntry']
+    save_download_cache(cache, cache_file)
+    if failures:
+        raise Exception(str(len(failures)) + ' file(s) could not be downloaded:\n  - ' + '\n  - '.join(failures))
+    return download_file_list
@@ -1,13 +1,27 @@
 import os
 import re
+import json
 import click
-import pathlib
+import threading
+import time
+import hashlib
 import urllib.parse
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import date, datetime
 import pkg_resources
-from rdflib import Graph, Literal, XSD, URIRef, Namespace
+from rdflib import Graph, Literal, XSD, URIRef, BNode, Namespace
 from rdflib.namespace import RDFS, DC, DCTERMS, VOID, SKOS, DCAT, PROV, FOAF
-from SPARQLWrapper import SPARQLWrapper, TURTLE, POST, JSON, JSONLD
+
+from d2s.hcls_stats import compute_approximate_hcls_stats, iter_sparql_triples, hcls_stats_to_rdf
+from d2s.metadata_cache import open_metadata_cache, get_cached_results, store_results, get_query_hash, METADATA_CACHE_SIZE
+from d2s.metadata_cache import read_journal, get_journal_results, write_journal_entry
+from d2s.defaults import DEFAULT_ISQL
+from d2s.graph_discovery import list_graphs, BIO2RDF_GRAPHS_FILTER
+from d2s.ntriples import open_rdf_file
+from d2s.query_log import open_query_log, timed, log_query, print_slowest_queries
+from d2s.sparql_client import sparql_select, sparql_construct
 
 # DATASET_NAMESPACE = 'https://w3id.org/d2s/dataset/'
 
@@ -18,6 +32,16 @@ IDOT = Namespace("http://identifiers.org/idot/")
 D2S = Namespace("https://w3id.org/d2s/vocab/")
 RDF = Namespace("http://www.w3.org/1999/02/22-rdf-syntax-ns#")
 
+# Ways to split the HCLS aggregation queries, and the GROUP BY variables used to split them
+SPLIT_MODES = ['auto', 'none', 'predicate', 'class', 'page']
+SPLIT_VARIABLES = {
+    'predicate': ['?p'],
+    'class': ['?stype', '?otype', '?o'],
+}
+GROUP_BY_REGEX = r'GROUP BY((\s+\?\w+)+)'
+# Index of the graphs analyzed for a metadata file, to only analyze the new or changed graphs with --incremental
+METADATA_INDEX_SUFFIX = '.d2s-index.json'
+
 
 def create_dataset_prompt(sparql_endpoint, distribution_uri, g=Graph(), output_file=None):
     """Create a new dataset from questions asked in the prompt"""
@@ -160,14 +184,43 @@ def create_dataset(metadata, sparql_endpoint, distribution_uri, g):
 
     return g
 
-def generate_hcls_from_sparql(sparql_endpoint, rdf_distribution_uri, metadata_type, graph, g=Graph(), create_dataset=False):
-    """Query the provided SPARQL endpoint to compute HCLS metadata"""
-    sparql = SPARQLWrapper(sparql_endpoint)
-    root = pathlib.Path(__file__).parent.resolve()
-    with open(root / '../REPORT_FAIL.md', 'w') as f:
-        f.write('# Failing HCLS SPARQL queries\n\n\n')
-    with open(root / '../REPORT_SUCCESS.md', 'w') as f:
-        f.write('# Generated HCLS metadata\n\n\n')
+def generate_hcls_from_sparql(sparql_endpoint, rdf_distribution_uri, metadata_type, graph, g=None, create_dataset=False, concurrency=1, split='auto', page_size=10000,
+        cache=True, refresh=False, cache_size=METADATA_CACHE_SIZE, graphs_source='query', graphs_filter=None, isql=DEFAULT_ISQL,
+        stream_output=None, stream_format='nt', per_graph=False, journal_file=None, resume=False, query_log=None):
+    """Query the provided SPARQL endpoint to compute HCLS metadata, see compute_hcls_from_sparql
+    Raise an exception if queries failed, instead of returning the metadata of some graphs partially computed
+    :return: the metadata graph
+    """
+    g, failed_graphs = compute_hcls_from_sparql(sparql_endpoint, rdf_distribution_uri, metadata_type, graph, g, create_dataset, concurrency,
+        split, page_size, cache, refresh, cache_size, graphs_source, graphs_filter, isql, stream_output, stream_format, per_graph,
+        journal_file, resume, query_log)
+    if failed_graphs:
+        raise Exception("HCLS queries failed for " + str(len(failed_graphs)) + " graphs: "
+            + ', '.join(graph + ' (' + str(failed_count) + ' queries)' for graph, failed_count in failed_graphs.items()))
+    return g
+
+
+def compute_hcls_from_sparql(sparql_endpoint, rdf_distribution_uri, metadata_type, graph, g=None, create_dataset=False, concurrency=1, split='auto', page_size=10000,
+        cache=True, refresh=False, cache_size=METADATA_CACHE_SIZE, graphs_source='query', graphs_filter=None, isql=DEFAULT_ISQL,
+        stream_output=None, stream_format='nt', per_graph=False, journal_file=None, resume=False, query_log=None, fingerprints=None):
+    """Query the provided SPARQL endpoint to compute HCLS metadata
+    Queries for all graphs are sent by a pool of concurrency workers, and their results
+    are merged in the graph in the same order as they would have been sequentially.
+    Aggregation queries with a GROUP BY can be split in smaller queries, see run_hcls_query.
+    Results are cached, and reused for graphs with the same fingerprint, unless refresh is enabled.
+    The graphs are listed with graphs_source, see d2s.graph_discovery.list_graphs
+    If stream_output is provided, the results are written to this file (or to one file per graph in this directory)
+    as soon as each query is merged, instead of being accumulated in g.
+    The results of the completed queries are recorded in journal_file, with resume the queries
+    already in the journal are not run again. The journal is deleted when all queries succeeded.
+    The timings of the queries are logged in the query_log JSON lines file, see d2s.query_log
+    :param fingerprints: dict of the fingerprints of the graphs already computed, see get_graph_fingerprint
+    :return: the metadata graph, and a dict of the number of failed queries per graph
+    """
+    if g is None:
+        g = Graph()
+    if split not in SPLIT_MODES:
+        raise Exception("Invalid split mode: " + split + ". Use one of " + ', '.join(SPLIT_MODES))
 
     query_prefixes = """PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
 PREFIX dqv: <http://www.w3.org/ns/dqv#>
@@ -179,30 +232,19 @@ PREFIX dcat: <http://www.w3.org/ns/dcat#>
 PREFIX void: <http://rdfs.org/ns/void#>
 PREFIX void-ext: <http://ldf.fi/void-ext#>\n"""
 
-    # If no specific graph provided we get graphs from the SPARQL endpoint
-    if not graph:
-        query_select_all_graphs = 'SELECT DISTINCT ?graph WHERE { GRAPH ?graph {?s ?p ?o} }'
-        sparql.setQuery(query_select_all_graphs)
-        sparql.setReturnFormat(JSON)
-        results = sparql.query().convert()
-        # print('Get all graphs query Results:')
-        # print(results)
-        select_all_graphs_results = results["results"]["bindings"]
-    else:
-        # Just query the single provided graph
-        select_all_graphs_results = [{ 'graph': {'value': str(graph)}}]
-
-    # Compute HCLS metadata per graph
-    for graph_row in select_all_graphs_results:
-        graph = graph_row['graph']['value']
-
-        if metadata_type == 'bio2rdf' and not graph.startswith('http://bio2rdf.org'):
-            # For bio2rdf ignore Virtuoso default graphs
-            continue
-
-        print('[' + str(datetime.now()) + '] Computing metadata for graph ' + graph)
-        for filename in os.listdir(pkg_resources.resource_filename('d2s', 'queries/' + metadata_type)):
-            with open(pkg_resources.resource_filename('d2s', 'queries/' + metadata_type + '/' + filename), 'r') as f:
+    if metadata_type == 'bio2rdf' and not graphs_filter:
+        # For bio2rdf ignore Virtuoso default graphs
+        graphs_filter = BIO2RDF_GRAPHS_FILTER
+    graphs = get_graphs_to_analyze(sparql_endpoint, graph, graphs_source, graphs_filter, isql)
+
+    # Prepare the HCLS queries to run for each graph
+    queries_dir = pkg_resources.resource_filename('d2s', 'queries/' + metadata_type)
+    graph_queries = []
+    for graph in graphs:
+        queries = []
+        # Sort the query files to always merge results in the same order
+        for filename in sorted(os.listdir(queries_dir)):
+            with open(os.path.join(queries_dir, filename), 'r') as f:
                 sparql_query = f.read()
 
                 # Define variables to replace for the different metadata type here
@@ -223,42 +265,393 @@ PREFIX void-ext: <http://ldf.fi/void-ext#>\n"""
                         sparql_query = sparql_query.replace('<?_graph_start>', '')
                         sparql_query = sparql_query.replace('<?_graph_end>', '')
 
-                complete_query = query_prefixes + sparql_query
-                # print(complete_query)
-
+                queries.append((filename, query_prefixes + sparql_query))
+        graph_queries.append((graph, queries))
+
+    # Compute HCLS metadata for all graphs x queries with a bounded pool of workers
+    partition_values = {}
+    partition_values_lock = threading.Lock()
+    cache_db = open_metadata_cache() if cache else None
+    journal_index = {}
+    if journal_file and resume:
+        journal_index = read_journal(journal_file, sparql_endpoint)
+        print('⏯️  Resuming from ' + journal_file + ', ' + str(len(journal_index)) + ' queries already completed')
+    journal = open(journal_file, 'a' if resume else 'w') if journal_file else None
+    failed_graphs = {}
+    query_log_file = open_query_log(query_log) if query_log else None
+    query_timings = []
+    stream = None
+    if stream_output and not per_graph:
+        stream = open_metadata_stream(stream_output, stream_format=stream_format)
+    with ThreadPoolExecutor(max_workers=max(1, int(concurrency))) as executor:
+        graphs_fingerprints = [None] * len(graph_queries)
+        if cache_db and fingerprints is not None:
+            graphs_fingerprints = [fingerprints.get(graph) for graph, queries in graph_queries]
+        elif cache_db:
+            graphs_fingerprints = list(executor.map(lambda graph_query: get_graph_fingerprint(sparql_endpoint, graph_query[0]), graph_queries))
+
+        def submit_query(graph, fingerprint, query_name, complete_query):
+            """Get the results from the journal, or the cache, otherwise submit the query to the pool
+            :return: the query and the future of its results, start time, wall time and exception
+            """
+            start_time = time.time()
+            start = time.perf_counter()
+            results_list = None
+            source = 'query'
+            journal_key = (graph, get_query_hash(complete_query))
+            if journal_key in journal_index:
+                results_list = get_journal_results(journal_file, journal_index[journal_key])
+                source = 'journal'
+            elif fingerprint and not refresh:
+                results_list = get_cached_results(cache_db, sparql_endpoint, graph, complete_query, fingerprint)
+                source = 'cache' if results_list is not None else 'query'
+            if results_list is not None:
+                future = Future()
+                future.set_result((results_list, start_time, time.perf_counter() - start, None))
+            else:
+                future = executor.submit(timed, run_hcls_query, sparql_endpoint, graph, complete_query,
+                    split, page_size, partition_values, partition_values_lock)
+            return query_name, complete_query, future, source
+
+        # Only a window of queries is submitted ahead, so the results waiting to be merged stay bounded
+        queries_to_run = ((graph, fingerprint, query_name, complete_query)
+            for (graph, queries), fingerprint in zip(graph_queries, graphs_fingerprints) for query_name, complete_query in queries)
+        submitted = deque(submit_query(*query) for query in islice(queries_to_run, max(1, int(concurrency)) * 2))
+
+        # Merge the results in the order the queries have been defined, not the order they complete
+        for (graph, queries), fingerprint in zip(graph_queries, graphs_fingerprints):
+            print('[' + str(datetime.now()) + '] Computing metadata for graph ' + graph)
+            if stream_output and per_graph:
+                stream = open_metadata_stream(stream_output, graph, stream_format)
+            cached_count = 0
+            resumed_count = 0
+            for _ in queries:
+                query_name, complete_query, future, source = submitted.popleft()
+                submitted.extend(submit_query(*query) for query in islice(queries_to_run, 1))
+                results_list, start_time, wall_time, error = future.result()
+                triples_count = 0
                 try:
-                    sparql.setQuery(complete_query)
-                    sparql.setReturnFormat(TURTLE)
-                    # sparql.setReturnFormat(JSONLD)
-                    results = sparql.query().convert()
-                    # g.parse(data=results, format="turtle")
+                    if error:
+                        raise error
                     # g.parse(data=results, format="json-ld")
-
-                    g.parse(data=results, format="turtle")
-                    with open(root / '../REPORT_SUCCESS.md', 'a') as f:
-                        # f.write('## Returned RDF \n\n```turtle\n' + results.decode('utf-8') + "\n```\n\n"
-                        f.write('## Successfull query \n\n'
-                            + '```sparql\n' + complete_query + "\n```\n\n"
-                            + 'In SPARQL endpoint: ' + sparql_endpoint + "\n\n---\n")
+                    for results in results_list:
+                        if stream:
+                            results_g = Graph()
+                            results_g.parse(data=results, format="turtle")
+                            write_metadata_stream(stream, results_g, graph, stream_format)
+                            triples_count += len(results_g)
+                        else:
+                            graph_size = len(g)
+                            g.parse(data=results, format="turtle")
+                            triples_count += len(g) - graph_size
+                    if fingerprint and source == 'query':
+                        store_results(cache_db, sparql_endpoint, graph, complete_query, fingerprint, results_list, cache_size)
+                    if journal and source != 'journal':
+                        write_journal_entry(journal, sparql_endpoint, graph, complete_query, results_list)
+                    cached_count += 1 if source == 'cache' else 0
+                    resumed_count += 1 if source == 'journal' else 0
                 except Exception as e:
+                    error = e
+                    failed_graphs[graph] = failed_graphs.get(graph, 0) + 1
                     print('SPARQL query failed:')
                     print(complete_query)
                     print(e)
-                    with open(root / '../REPORT_FAIL.md', 'a') as f:
-                        f.write('## Query failed \n\n```sparql\n' + complete_query + "\n```\n\n"
-                            + 'In SPARQL endpoint: ' + sparql_endpoint + "\n> "
-                            + str(e) + "\n\n---\n")
-
-        if create_dataset:
-            g, metadata_answers = create_dataset_prompt(sparql_endpoint, graph, g)
-            # dataset_uri = f"{graph}/dataset"
-            # g, metadata_answers = create_dataset_prompt(dataset_uri, g)
-
+                if query_log_file:
+                    query_timing = {
+                        'time': datetime.fromtimestamp(start_time).isoformat(),
+                        'endpoint': sparql_endpoint,
+                        'graph': graph,
+                        'query': query_name,
+                        'source': source,
+                        'status': 'failed' if error else 'success',
+                        'wall_time': round(wall_time, 3),
+                        'bytes': sum(len(results if isinstance(results, bytes) else results.encode('utf-8')) for results in results_list or []),
+                        'triples': triples_count,
+                    }
+                    if error:
+                        query_timing['error'] = str(error)
+                    log_query(query_log_file, query_timing)
+                    query_timings.append(query_timing)
+            if cached_count > 0:
+                print('⏩️ ' + str(cached_count) + ' queries results reused from the cache, the graph did not change (' + fingerprint + ')')
+            if resumed_count > 0:
+                print('⏯️  ' + str(resumed_count) + ' queries results resumed from the journal')
+            if stream_output and per_graph:
+                stream.close()
+
+            if create_dataset:
+                g, metadata_answers = create_dataset_prompt(sparql_endpoint, graph, g)
+                # dataset_uri = f"{graph}/dataset"
+                # g, metadata_answers = create_dataset_prompt(dataset_uri, g)
+
+    if stream_output and not per_graph:
+        stream.close()
+    if query_log_file:
+        query_log_file.close()
+        print_slowest_queries(query_timings)
+        print('⏱️  Timings of all queries logged in ' + query_log)
+    if journal:
+        journal.close()
+        if not failed_graphs:
+            os.remove(journal_file)
+        else:
+            print('⚠️  ' + str(sum(failed_graphs.values())) + ' queries failed, run again with --resume to only retry them')
+    if cache_db:
+        cache_db.close()
     # print(g.serialize(format='json-ld', indent=4))
     # print(g.serialize(format='turtle', indent=4))
+    return g, failed_graphs
+
+
+def get_graph_file_name(graph):
+    """Name of the file storing the metadata of a graph, readable and unique"""
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', re.sub(r'^\w+://', '', graph)).strip('_')[:100] + '-' + hashlib.sha1(graph.encode('utf-8')).hexdigest()[:8]
+
+
+def open_metadata_stream(output, graph=None, stream_format='nt'):
+    """Open the file to stream the metadata to, or the file of a graph in the output directory (gzipped if output ends with .gz)"""
+    if graph:
+        os.makedirs(output, exist_ok=True)
+        output = os.path.join(output, get_graph_file_name(graph) + '.' + stream_format)
+    return open_rdf_file(output, 'wt')
+
+
+def write_metadata_stream(f, g, graph=None, stream_format='nt'):
+    """Append the statements of a query result to the stream, in the analyzed graph for N-Quads,
+    and flush them so partial results are kept if the analysis crashes"""
+    for line in g.serialize(format='nt').splitlines():
+        if not line.strip():
+            continue
+        if stream_format == 'nq' and graph:
+            # N-Triples statements end with ' .', add the graph before
+            line = line[:-1] + '<' + graph + '> .'
+        f.write(line + '\n')
+    f.flush()
+
+
+def get_graphs_to_analyze(sparql_endpoint, graph=None, graphs_source='query', graphs_filter=None, isql=DEFAULT_ISQL):
+    """Get the graphs of the triplestore, or just the provided graph(s), filtered with the graphs_filter regex"""
+    if not graph:
+        # If no specific graph provided we get graphs from the triplestore
+        return list_graphs(sparql_endpoint, graphs_source, graphs_filter, isql)
+    graphs = [str(graph_uri) for graph_uri in graph] if isinstance(graph, list) else [str(graph)]
+    if graphs_filter:
+        graphs = [graph_uri for graph_uri in graphs if re.search(graphs_filter, graph_uri)]
+    return graphs
+
+
+def get_graph_fingerprint(sparql_endpoint, graph):
+    """Cheap fingerprint of a graph, to know if it changed: its modification date (pav:lastUpdateOn or
+    dcterms:modified of the graph) if defined, otherwise its number of triples
+    :return: the fingerprint, or None if it could not be computed
+    """
+    try:
+        results = sparql_select(sparql_endpoint, 'SELECT ?modified WHERE { <' + graph + '> <http://purl.org/pav/lastUpdateOn>|<http://purl.org/dc/terms/modified> ?modified } ORDER BY DESC(?modified) LIMIT 1')
+        if results:
+            return 'modified=' + results[0]['modified']['value']
+        results = sparql_select(sparql_endpoint, 'SELECT (COUNT(*) AS ?triples) WHERE { GRAPH <' + graph + '> { ?s ?p ?o } }')
+        return 'triples=' + results[0]['triples']['value']
+    except Exception as e:
+        print('⚠️  Could not compute the fingerprint of the graph ' + graph + ', its results will not be cached: ' + str(e))
+        return None
+
+
+def remove_graph_metadata(g, graph):
+    """Remove the HCLS metadata of a graph, and the blank nodes of its partitions"""
+    nodes = [URIRef(graph)]
+    while nodes:
+        node = nodes.pop()
+        for triple in list(g.triples((node, None, None))):
+            g.remove(triple)
+            if isinstance(triple[2], BNode):
+                nodes.append(triple[2])
+
+
+def update_hcls_from_sparql(sparql_endpoint, metadata_file, graph=None, concurrency=1, graphs_source='query', graphs_filter=None, isql=DEFAULT_ISQL, **kwargs):
+    """Update the HCLS metadata in metadata_file by only analyzing the graphs which are new or changed since the last update.
+    An index of the fingerprint (modification date or number of triples) of each analyzed graph is kept next to the metadata file.
+    The metadata of the changed graphs, and of the graphs which do not exist anymore, is replaced in the existing metadata
+    :return: the updated metadata graph
+    """
+    index_file = metadata_file + METADATA_INDEX_SUFFIX
+    index = { 'endpoint': sparql_endpoint, 'graphs': {} }
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+    if index['endpoint'] != sparql_endpoint:
+        print('⚠️  The metadata in ' + metadata_file + ' has been generated for ' + index['endpoint'] + ', analyzing all graphs')
+        index = { 'endpoint': sparql_endpoint, 'graphs': {} }
+    g = Graph()
+    if os.path.exists(metadata_file) and index['graphs']:
+        g.parse(metadata_file, format='turtle')
+
+    graphs = get_graphs_to_analyze(sparql_endpoint, graph, graphs_source, graphs_filter, isql)
+    with ThreadPoolExecutor(max_workers=max(1, int(concurrency))) as executor:
+        fingerprints = list(executor.map(lambda graph_uri: get_graph_fingerprint(sparql_endpoint, graph_uri), graphs))
+    changed_graphs = [graph_uri for graph_uri, fingerprint in zip(graphs, fingerprints)
+        if not fingerprint or index['graphs'].get(graph_uri, {}).get('fingerprint') != fingerprint]
+    # Graphs which are not in the endpoint anymore, only when analyzing all graphs
+    removed_graphs = [graph_uri for graph_uri in index['graphs'].keys() if graph_uri not in graphs] if not graph else []
+    print('🔄 ' + str(len(changed_graphs)) + ' new or changed graphs to analyze, '
+        + str(len(graphs) - len(changed_graphs)) + ' unchanged, ' + str(len(removed_graphs)) + ' removed')
+
+    for graph_uri in changed_graphs + removed_graphs:
+        remove_graph_metadata(g, graph_uri)
+        index['graphs'].pop(graph_uri, None)
+    failed_graphs = {}
+    if changed_graphs:
+        g, failed_graphs = compute_hcls_from_sparql(sparql_endpoint, None, 'hcls', changed_graphs, g, concurrency=concurrency,
+            fingerprints=dict(zip(graphs, fingerprints)), **kwargs)
+    # The graphs with failed queries are not indexed, so they are analyzed again by the next update
+    for graph_uri, fingerprint in zip(graphs, fingerprints):
+        if graph_uri in changed_graphs and fingerprint and graph_uri not in failed_graphs:
+            index['graphs'][graph_uri] = { 'fingerprint': fingerprint, 'analyzed': datetime.now().isoformat() }
+
+    g.serialize(destination=metadata_file, format='turtle')
+    with open(index_file, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
     return g
 
 
+def generate_approximate_hcls_from_sparql(sparql_endpoint, graph, g=None, error=0.02, page_size=10000, graphs_source='query', graphs_filter=None, isql=DEFAULT_ISQL,
+        stream_output=None, stream_format='nt', per_graph=False, journal_file=None, resume=False):
+    """Compute HCLS metadata for the graphs of a SPARQL endpoint by paging their triples out of the endpoint,
+    and estimating the distinct counts with HyperLogLog sketches, instead of running COUNT(DISTINCT) queries
+    which time out on large graphs. The relative error of the estimations is added to the metadata.
+    If stream_output is provided, the metadata of each graph is written to it, and the metadata of the
+    analyzed graphs is recorded in journal_file to resume, see generate_hcls_from_sparql"""
+    if g is None:
+        g = Graph()
+    journal_index = {}
+    if journal_file and resume:
+        journal_index = read_journal(journal_file, sparql_endpoint)
+        print('⏯️  Resuming from ' + journal_file + ', ' + str(len(journal_index)) + ' graphs already analyzed')
+    journal = open(journal_file, 'a' if resume else 'w') if journal_file else None
+    # Recorded in the journal instead of a query, the results depend on the error
+    journal_query = 'approximate error=' + str(error)
+    stream = None
+    if stream_output and not per_graph:
+        stream = open_metadata_stream(stream_output, stream_format=stream_format)
+    for graph in get_graphs_to_analyze(sparql_endpoint, graph, graphs_source, graphs_filter, isql):
+        journal_key = (graph, get_query_hash(journal_query))
+        if journal_key in journal_index:
+            print('⏯️  Approximate metadata for graph ' + graph + ' resumed from the journal')
+            results = get_journal_results(journal_file, journal_index[journal_key])[0]
+        else:
+            print('[' + str(datetime.now()) + '] Computing approximate metadata for graph ' + graph)
+            stats = compute_approximate_hcls_stats(lambda: iter_sparql_triples(sparql_endpoint, graph, page_size),
+                lambda: iter_sparql_triples(sparql_endpoint, graph, page_size, types_only=True), error)
+            results = hcls_stats_to_rdf(stats, graph, Graph()).serialize(format='turtle')
+            if journal:
+                write_journal_entry(journal, sparql_endpoint, graph, journal_query, [results])
+        if not stream_output:
+            g.parse(data=results, format='turtle')
+            continue
+        graph_g = Graph()
+        graph_g.parse(data=results, format='turtle')
+        if per_graph:
+            with open_metadata_stream(stream_output, graph, stream_format) as graph_stream:
+                write_metadata_stream(graph_stream, graph_g, graph, stream_format)
+        else:
+            write_metadata_stream(stream, graph_g, graph, stream_format)
+    if stream:
+        stream.close()
+    if journal:
+        journal.close()
+        os.remove(journal_file)
+    return g
+
+
+def get_group_by_variables(sparql_query):
+    """Variables of the GROUP BY clause of the aggregation subquery of a HCLS query"""
+    group_by = re.search(GROUP_BY_REGEX, sparql_query)
+    return group_by.group(1).split() if group_by else []
+
+
+def get_split_variable(sparql_query, split):
+    """Variable used to split a query: the property for 'predicate', the subject or object class for 'class'
+    Splitting by one of the GROUP BY variables gives disjoint groups, so the results of the parts can just be merged"""
+    group_by_variables = get_group_by_variables(sparql_query)
+    split_variables = SPLIT_VARIABLES.get(split, [])
+    for variable in split_variables:
+        if variable in group_by_variables:
+            return variable
+    return None
+
+
+def restrict_query(sparql_query, variable, value):
+    """Restrict the aggregation subquery of a HCLS query to one value of a variable, with VALUES"""
+    where_start = sparql_query.index('{', re.search(r'\bSELECT\b', sparql_query).end()) + 1
+    return sparql_query[:where_start] + ' VALUES ' + variable + ' { <' + value + '> } ' + sparql_query[where_start:]
+
+
+def page_query(sparql_query, page_size, offset):
+    """Get one page of the groups of the aggregation subquery of a HCLS query, ordered by the GROUP BY variables"""
+    group_by = re.search(GROUP_BY_REGEX, sparql_query)
+    return (sparql_query[:group_by.end()] + ' ORDER BY' + group_by.group(1)
+        + ' LIMIT ' + str(page_size) + ' OFFSET ' + str(offset) + sparql_query[group_by.end():])
+
+
+def list_partition_values(sparql_endpoint, graph, split):
+    """List the properties, or the classes, of a graph to split the HCLS queries"""
+    pattern = '?s ?value ?o' if split == 'predicate' else '?s a ?value'
+    if graph:
+        pattern = 'GRAPH <' + graph + '> { ' + pattern + ' }'
+    results = sparql_select(sparql_endpoint, 'SELECT DISTINCT ?value WHERE { ' + pattern + ' }')
+    return [row['value']['value'] for row in results if row['value']['type'] == 'uri']
+
+
+def run_hcls_query(sparql_endpoint, graph, complete_query, split='none', page_size=10000, partition_values=None, partition_values_lock=None):
+    """Run a HCLS CONSTRUCT query, splitting its aggregation in smaller queries to avoid endpoint timeouts:
+    - none: run the query as is
+    - auto: run the query as is, and if it fails split it by predicate
+    - predicate: one query per property of the graph (for queries grouped by ?p)
+    - class: one query per class of the graph (for queries grouped by a class)
+    - page: get the groups by pages of page_size, with ORDER BY, LIMIT and OFFSET
+    Queries without GROUP BY are always run as is, since their counts can not be combined
+    :param partition_values: dict of the properties and classes of the graphs, shared by the queries with its lock
+    :return: the list of Turtle results of the queries
+    """
+    if partition_values is None:
+        partition_values = {}
+    if partition_values_lock is None:
+        partition_values_lock = threading.Lock()
+    if split in ['none', 'auto'] or not get_group_by_variables(complete_query):
+        try:
+            return [run_construct_query(sparql_endpoint, complete_query)]
+        except Exception as e:
+            if split != 'auto' or not get_split_variable(complete_query, 'predicate'):
+                raise e
+            print('⚠️  Query failed, splitting it by predicate: ' + str(e))
+            split = 'predicate'
+
+    if split == 'page':
+        results_list = []
+        offset = 0
+        while True:
+            results = run_construct_query(sparql_endpoint, page_query(complete_query, page_size, offset))
+            if len(Graph().parse(data=results, format='turtle')) == 0:
+                return results_list
+            results_list.append(results)
+            offset += page_size
+
+    variable = get_split_variable(complete_query, split)
+    if not variable:
+        return [run_construct_query(sparql_endpoint, complete_query)]
+    # The properties and classes of a graph are only listed once, for all the queries
+    with partition_values_lock:
+        if (graph, split) not in partition_values:
+            partition_values[(graph, split)] = list_partition_values(sparql_endpoint, graph, split)
+    values = partition_values[(graph, split)]
+    print('✂️  Splitting a query in ' + str(len(values)) + ' queries by ' + split + ' for graph ' + graph)
+    return [run_construct_query(sparql_endpoint, restrict_query(complete_query, variable, value)) for value in values]
+
+
+def run_construct_query(sparql_endpoint, complete_query):
+    """Run a CONSTRUCT query and return the Turtle results"""
+    return sparql_construct(sparql_endpoint, complete_query)
+
+
 # {
 #   "@context": "/contexts/GraphMap",
 #   "@id": "/graph_maps",
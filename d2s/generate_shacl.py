@@ -7,7 +7,6 @@ from datetime import date, datetime
 import pkg_resources
 from rdflib import Graph, Literal, RDF, XSD, URIRef, Namespace
 from rdflib.namespace import RDFS, DC, DCTERMS, VOID, SKOS, DCAT, PROV, FOAF
-from SPARQLWrapper import SPARQLWrapper, TURTLE, POST, JSON, JSONLD
 
 DATASET_NAMESPACE = 'https://w3id.org/d2s/dataset/'
 
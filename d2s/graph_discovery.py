@@ -0,0 +1,76 @@
+"""List the graphs of a triplestore to compute their metadata, with different backends,
+since the generic SPARQL query scans all the quads of the triplestore"""
+import os
+import re
+import shlex
+import subprocess
+import requests
+
+from d2s.defaults import DEFAULT_ISQL
+from d2s.sparql_client import sparql_select, sparql_request
+
+GRAPHS_SOURCES = ['query', 'virtuoso', 'rdf4j', 'file:<path>']
+# Filter applied to the graphs listed for bio2rdf metadata, to ignore the Virtuoso default graphs
+BIO2RDF_GRAPHS_FILTER = r'^http://bio2rdf\.org'
+IRI_LINE_REGEX = r'^[A-Za-z][A-Za-z0-9+.-]*:\S+$'
+
+
+def list_graphs_with_query(sparql_endpoint):
+    """Generic SPARQL query, supported by all triplestores, but scanning all the quads"""
+    results = sparql_select(sparql_endpoint, 'SELECT DISTINCT ?graph WHERE { GRAPH ?graph {?s ?p ?o} }')
+    return [row['graph']['value'] for row in results]
+
+
+def list_graphs_with_virtuoso(isql=DEFAULT_ISQL):
+    """Get the graphs known by Virtuoso with DB.DBA.SPARQL_SELECT_KNOWN_GRAPHS(), which does not scan the quads.
+    The procedure is run with the isql command (e.g. docker exec -i virtuoso isql-v), as the dba user
+    with the password in the DBA_PASSWORD environment variable"""
+    isql_cmd = shlex.split(isql) + ['dba', os.getenv('DBA_PASSWORD', 'dba'), 'exec=DB.DBA.SPARQL_SELECT_KNOWN_GRAPHS();']
+    isql_run = subprocess.run(isql_cmd, capture_output=True, text=True)
+    if isql_run.returncode != 0:
+        raise Exception('Listing the Virtuoso graphs with ' + isql + ' failed: ' + isql_run.stderr)
+    # isql prints headers and a summary around the graphs IRIs, one per line
+    return [line.strip() for line in isql_run.stdout.splitlines() if re.match(IRI_LINE_REGEX, line.strip())]
+
+
+def list_graphs_with_rdf4j(repository_url):
+    """List the graphs with the GraphDB /rdf-graphs API, or the RDF4J /contexts API, of the repository"""
+    headers = { 'Accept': 'application/sparql-results+json' }
+    try:
+        results = sparql_request('GET', repository_url.rstrip('/') + '/rdf-graphs', headers=headers).json()
+    except requests.HTTPError as e:
+        if e.response.status_code != 404:
+            raise e
+        results = sparql_request('GET', repository_url.rstrip('/') + '/contexts', headers=headers).json()
+    graph_var = results['head']['vars'][0]
+    return [row[graph_var]['value'] for row in results['results']['bindings'] if graph_var in row]
+
+
+def list_graphs_from_file(graphs_file):
+    """Read the graphs from a file, one graph per line, ignoring empty lines and comments"""
+    with open(graphs_file) as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+
+def list_graphs(sparql_endpoint, graphs_source='query', graphs_filter=None, isql=DEFAULT_ISQL):
+    """List the graphs of a triplestore with one of the GRAPHS_SOURCES:
+    - query: generic SPARQL query on the endpoint
+    - virtuoso: DB.DBA.SPARQL_SELECT_KNOWN_GRAPHS() with isql
+    - rdf4j: GraphDB/RDF4J API of the repository (the endpoint URL)
+    - file:<path>: one graph per line in the file
+    :param graphs_filter: only keep the graphs matching this regex
+    """
+    if graphs_source == 'query':
+        graphs = list_graphs_with_query(sparql_endpoint)
+    elif graphs_source == 'virtuoso':
+        graphs = list_graphs_with_virtuoso(isql)
+    elif graphs_source == 'rdf4j':
+        graphs = list_graphs_with_rdf4j(sparql_endpoint)
+    elif graphs_source.startswith('file:'):
+        graphs = list_graphs_from_file(graphs_source[len('file:'):])
+    else:
+        raise Exception("Invalid graphs source: " + graphs_source + ". Use one of " + ', '.join(GRAPHS_SOURCES))
+    if graphs_filter:
+        graphs = [graph for graph in graphs if re.search(graphs_filter, graph)]
+    print('🔎 ' + str(len(graphs)) + ' graphs found with ' + graphs_source.split(':')[0])
+    return graphs
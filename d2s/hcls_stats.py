@@ -0,0 +1,407 @@
+"""Compute HCLS descriptive statistics from N-Triples files in a single streaming pass,
+producing the same VoID RDF as the SPARQL queries in d2s/queries/hcls, without a triplestore"""
+import time
+from datetime import datetime
+from array import array
+from rdflib import Graph, Literal, URIRef, BNode, Namespace, XSD
+from rdflib.namespace import RDF, RDFS, VOID
+from rdflib.plugins.parsers.ntriples import unquote
+
+from d2s.ntriples import iter_statements
+from d2s.hyperloglog import new_sketch, sketch_error, hash_term, add_hash, estimate_count
+from d2s.sparql_client import sparql_select
+
+VOID_EXT = Namespace("http://ldf.fi/void-ext#")
+D2S = Namespace("https://w3id.org/d2s/vocab/")
+
+RDF_TYPE = '<' + str(RDF.type) + '>'
+RDFS_LABEL = '<' + str(RDFS.label) + '>'
+
+
+def split_statement(statement):
+    """Split a N-Triples statement in its subject, predicate and object, as N-Triples terms.
+    IRIs and blank nodes can not contain spaces, so only the object (which can be a literal) needs care
+    """
+    if statement.endswith('.'):
+        statement = statement[:-1].rstrip()
+    subject, predicate, obj = statement.split(None, 2)
+    return subject, predicate, obj
+
+
+def to_rdflib_term(term):
+    """Convert a N-Triples term to a rdflib term"""
+    if term.startswith('<'):
+        return URIRef(unquote(term[1:-1]) if '\\' in term else term[1:-1])
+    if term.startswith('_:'):
+        return BNode(term[2:])
+    g = Graph()
+    g.parse(data='<urn:d2s:s> <urn:d2s:p> ' + term + ' .', format='nt')
+    return next(g.objects())
+
+
+def iter_file_triples(rdf_files):
+    """Iterate over the triples of N-Triples files, as tuples of N-Triples terms"""
+    for rdf_file in rdf_files:
+        print('[' + str(datetime.now()) + '] 📊 Reading ' + rdf_file)
+        for statement in iter_statements(rdf_file):
+            yield split_statement(statement)
+
+
+def sparql_term_to_nt(binding):
+    """Convert a term from SPARQL JSON results to a N-Triples term"""
+    if binding['type'] == 'uri':
+        return '<' + binding['value'] + '>'
+    if binding['type'] == 'bnode':
+        return '_:' + binding['value']
+    return Literal(binding['value'], lang=binding.get('xml:lang'), datatype=binding.get('datatype')).n3()
+
+
+def iter_sparql_triples(sparql_endpoint, graph=None, page_size=10000, types_only=False):
+    """Iterate over the triples of a graph in a SPARQL endpoint, as tuples of N-Triples terms,
+    fetching the triples of each property by pages, so that no query has to scan and aggregate the whole graph.
+    Pages are ordered by subject and object, since the order of the results of 2 queries is only stable with an ORDER BY,
+    and paging each property separately keeps the offsets, which get slower when deeper, smaller than for the whole graph"""
+    graph_pattern = lambda pattern: 'GRAPH <' + graph + '> { ' + pattern + ' }' if graph else pattern
+    if types_only:
+        predicates = [str(RDF.type)]
+    else:
+        rows = sparql_select(sparql_endpoint, 'SELECT DISTINCT ?p WHERE { ' + graph_pattern('?s ?p ?o') + ' }')
+        predicates = [row['p']['value'] for row in rows]
+    fetched = 0
+    for predicate in predicates:
+        pattern = graph_pattern('?s <' + predicate + '> ?o')
+        offset = 0
+        while True:
+            rows = sparql_select(sparql_endpoint, 'SELECT ?s ?o WHERE { ' + pattern + ' } ORDER BY ?s ?o LIMIT ' + str(page_size) + ' OFFSET ' + str(offset))
+            for row in rows:
+                yield sparql_term_to_nt(row['s']), '<' + predicate + '>', sparql_term_to_nt(row['o'])
+            offset += len(rows)
+            if len(rows) < page_size:
+                break
+        fetched += offset
+        print('[' + str(datetime.now()) + '] 📊 Fetched ' + str(fetched) + (' types' if types_only else ' triples') + ' from ' + (graph or sparql_endpoint))
+
+
+def compute_hcls_stats(rdf_files):
+    """Compute the HCLS statistics of N-Triples files (optionally gzipped), read once line by line.
+    Terms are interned to integers, so that the counters only store ints. Statements are expected
+    to be unique, as in the output of d2s run, like they would be once loaded in a triplestore
+    :return: a dict with the counts for each HCLS query, and the terms to resolve the ids
+    """
+    term_ids = {}
+    terms = []
+    def term_id(term):
+        tid = term_ids.get(term)
+        if tid is None:
+            tid = len(terms)
+            term_ids[term] = tid
+            terms.append(term)
+        return tid
+
+    type_id = term_id(RDF_TYPE)
+    label_id = term_id(RDFS_LABEL)
+    triples = 0
+    # Number of triples for each subject and predicate pair
+    pair_counts = {}
+    # Triples with a literal object: triples and distinct literals per predicate
+    literals = set()
+    literal_triples = {}
+    literal_pairs = set()
+    # Triples with an IRI or blank node object, kept as 3 arrays of ids to join them with the types afterward
+    objects = set()
+    edges_s, edges_p, edges_o = array('q'), array('q'), array('q')
+    types = {}
+    labels = {}
+
+    for rdf_file in rdf_files:
+        print('[' + str(datetime.now()) + '] 📊 Computing HCLS statistics for ' + rdf_file)
+        start_time = time.time()
+        file_triples = 0
+        for statement in iter_statements(rdf_file):
+            subject, predicate, obj = split_statement(statement)
+            s = term_id(subject)
+            p = term_id(predicate)
+            o = term_id(obj)
+            file_triples += 1
+            pair_counts[(s, p)] = pair_counts.get((s, p), 0) + 1
+            if obj.startswith('"'):
+                literals.add(o)
+                literal_triples[p] = literal_triples.get(p, 0) + 1
+                literal_pairs.add((p, o))
+                if p == label_id:
+                    labels.setdefault(s, []).append(o)
+            else:
+                objects.add(o)
+                edges_s.append(s)
+                edges_p.append(p)
+                edges_o.append(o)
+            if p == type_id:
+                types.setdefault(s, set()).add(o)
+        triples += file_triples
+        run_time = max(time.time() - start_time, 0.001)
+        print('📊 Read ' + str(file_triples) + ' triples in ' + str(round(run_time, 2)) + 's ('
+            + str(int(file_triples / run_time)) + ' triples/s)')
+
+    stats = {
+        'terms': terms,
+        'triples': triples,
+        'entities': len(types),
+        'distinctSubjects': len(set(s for s, p in pair_counts)),
+        'properties': len(set(p for s, p in pair_counts)),
+        'distinctObjects': len(objects),
+        'distinctLiterals': len(literals),
+        'labels': labels,
+    }
+
+    # 2_2 distinct instances per class
+    class_instances = {}
+    for s, classes in types.items():
+        for c in classes:
+            class_instances[c] = class_instances.get(c, 0) + 1
+    stats['distinctClasses'] = len(class_instances)
+    stats['classInstances'] = class_instances
+
+    # 2_3 triples and distinct typed subjects per property and subject class
+    property_subject_classes = {}
+    for (s, p), count in pair_counts.items():
+        for stype in types.get(s, ()):
+            partition = property_subject_classes.setdefault((p, stype), [0, 0])
+            partition[0] += count
+            partition[1] += 1
+    stats['propertySubjectClasses'] = property_subject_classes
+
+    # 2_4 triples and distinct typed objects per property and object class
+    # 2_6 distinct subjects and objects per property, subject class and object class
+    object_pair_counts = {}
+    subject_object_classes = {}
+    for s, p, o in zip(edges_s, edges_p, edges_o):
+        object_types = types.get(o)
+        if not object_types:
+            continue
+        object_pair_counts[(p, o)] = object_pair_counts.get((p, o), 0) + 1
+        for stype in types.get(s, ()):
+            for otype in object_types:
+                partition = subject_object_classes.get((p, stype, otype))
+                if partition is None:
+                    partition = (set(), set())
+                    subject_object_classes[(p, stype, otype)] = partition
+                partition[0].add(s)
+                partition[1].add(o)
+    property_object_classes = {}
+    for (p, o), count in object_pair_counts.items():
+        for otype in types[o]:
+            partition = property_object_classes.setdefault((p, otype), [0, 0])
+            partition[0] += count
+            partition[1] += 1
+    stats['propertyObjectClasses'] = property_object_classes
+    stats['subjectObjectClasses'] = dict((key, (len(partition[0]), len(partition[1])))
+        for key, partition in subject_object_classes.items())
+
+    # 2_5 triples and distinct literals per property
+    property_literals = {}
+    for p, o in literal_pairs:
+        property_literals[p] = property_literals.get(p, 0) + 1
+    stats['propertyLiterals'] = dict((p, (literal_triples[p], count)) for p, count in property_literals.items())
+    return stats
+
+
+def compute_approximate_hcls_stats(iter_triples, iter_type_triples, error=0.02):
+    """Compute the HCLS statistics with HyperLogLog sketches for the distinct counts, so that the memory used
+    does not grow with the number of distinct subjects, objects and literals. The types of the subjects are read first,
+    with a smaller pass on the rdf:type triples, then all triples are read once to fill the sketches of each partition.
+    The types are indexed by the hash of each typed subject, so the memory still grows with the number of typed
+    entities (about 100 bytes per entity with one class, instead of the terms themselves).
+    Triples counts, classes and properties are exact, distinct subjects, objects and literals are estimated
+    :param iter_triples: function returning an iterator over all the triples, as tuples of N-Triples terms
+    :param iter_type_triples: function returning an iterator over the rdf:type triples
+    :return: a dict with the same counts as compute_hcls_stats, and the relative error of the estimations
+    """
+    term_ids = {}
+    terms = []
+    def term_id(term):
+        tid = term_ids.get(term)
+        if tid is None:
+            tid = len(terms)
+            term_ids[term] = tid
+            terms.append(term)
+        return tid
+
+    # Classes of each subject, indexed by the 64 bits hash of the subject
+    types = {}
+    for subject, predicate, obj in iter_type_triples():
+        if predicate != RDF_TYPE:
+            continue
+        subject_hash = hash_term(subject)
+        subject_types = types.get(subject_hash, ())
+        c = term_id(obj)
+        if c not in subject_types:
+            types[subject_hash] = subject_types + (c,)
+    class_terms = set(terms)
+
+    triples = 0
+    properties = set()
+    subjects_sketch, objects_sketch, literals_sketch = new_sketch(error), new_sketch(error), new_sketch(error)
+    property_subject_classes = {}
+    property_object_classes = {}
+    property_literals = {}
+    subject_object_classes = {}
+    labels = {}
+    for subject, predicate, obj in iter_triples():
+        triples += 1
+        p = term_id(predicate)
+        properties.add(p)
+        subject_hash = hash_term(subject)
+        object_hash = hash_term(obj)
+        add_hash(subjects_sketch, subject_hash)
+        subject_types = types.get(subject_hash, ())
+        for stype in subject_types:
+            partition = property_subject_classes.get((p, stype))
+            if partition is None:
+                partition = property_subject_classes[(p, stype)] = [0, new_sketch(error)]
+            partition[0] += 1
+            add_hash(partition[1], subject_hash)
+
+        if obj.startswith('"'):
+            add_hash(literals_sketch, object_hash)
+            partition = property_literals.get(p)
+            if partition is None:
+                partition = property_literals[p] = [0, new_sketch(error)]
+            partition[0] += 1
+            add_hash(partition[1], object_hash)
+            if predicate == RDFS_LABEL and subject in class_terms:
+                labels.setdefault(term_id(subject), []).append(term_id(obj))
+            continue
+
+        add_hash(objects_sketch, object_hash)
+        for otype in types.get(object_hash, ()):
+            partition = property_object_classes.get((p, otype))
+            if partition is None:
+                partition = property_object_classes[(p, otype)] = [0, new_sketch(error)]
+            partition[0] += 1
+            add_hash(partition[1], object_hash)
+            for stype in subject_types:
+                partition = subject_object_classes.get((p, stype, otype))
+                if partition is None:
+                    partition = subject_object_classes[(p, stype, otype)] = (new_sketch(error), new_sketch(error))
+                add_hash(partition[0], subject_hash)
+                add_hash(partition[1], object_hash)
+
+    class_instances = {}
+    for subject_types in types.values():
+        for c in subject_types:
+            class_instances[c] = class_instances.get(c, 0) + 1
+    return {
+        'terms': terms,
+        'triples': triples,
+        'entities': len(types),
+        'distinctSubjects': estimate_count(subjects_sketch),
+        'properties': len(properties),
+        'distinctObjects': estimate_count(objects_sketch),
+        'distinctLiterals': estimate_count(literals_sketch),
+        'distinctClasses': len(class_instances),
+        'classInstances': class_instances,
+        'labels': labels,
+        'propertySubjectClasses': dict((key, (partition_triples, estimate_count(sketch))) for key, (partition_triples, sketch) in property_subject_classes.items()),
+        'propertyObjectClasses': dict((key, (partition_triples, estimate_count(sketch))) for key, (partition_triples, sketch) in property_object_classes.items()),
+        'propertyLiterals': dict((key, (partition_triples, estimate_count(sketch))) for key, (partition_triples, sketch) in property_literals.items()),
+        'subjectObjectClasses': dict((key, (estimate_count(s_sketch), estimate_count(o_sketch))) for key, (s_sketch, o_sketch) in subject_object_classes.items()),
+        'relativeError': sketch_error(subjects_sketch),
+    }
+
+
+def hcls_stats_to_rdf(stats, dataset_uri, g=None):
+    """Add the HCLS statistics to a graph, with the same shape as the RDF returned by the HCLS queries"""
+    if g is None:
+        g = Graph()
+    g.bind('void', VOID)
+    g.bind('void-ext', VOID_EXT)
+    terms = stats['terms']
+    term = lambda tid: to_rdflib_term(terms[tid])
+    dataset = URIRef(dataset_uri)
+
+    # 1_1 to 1_7 dataset statistics
+    g.add((dataset, RDF.type, VOID.Dataset))
+    g.add((dataset, VOID.triples, Literal(stats['triples'])))
+    g.add((dataset, VOID.entities, Literal(stats['entities'])))
+    g.add((dataset, VOID.distinctSubjects, Literal(stats['distinctSubjects'])))
+    g.add((dataset, VOID.properties, Literal(stats['properties'])))
+    g.add((dataset, VOID.distinctObjects, Literal(stats['distinctObjects'])))
+    if 'relativeError' in stats:
+        # Distinct counts estimated with HyperLogLog sketches
+        g.bind('d2s', D2S)
+        g.add((dataset, D2S.distinctCountEstimator, Literal('HyperLogLog')))
+        g.add((dataset, D2S.distinctCountRelativeError, Literal(round(stats['relativeError'], 6), datatype=XSD.decimal)))
+    for class_uri, count in [(RDFS.Class, stats['distinctClasses']), (RDFS.Literal, stats['distinctLiterals'])]:
+        class_partition = BNode()
+        g.add((dataset, VOID.classPartition, class_partition))
+        g.add((class_partition, VOID['class'], class_uri))
+        g.add((class_partition, VOID.distinctSubjects, Literal(count)))
+
+    # 2_2 class partitions
+    for c, count in stats['classInstances'].items():
+        class_partition = BNode()
+        g.add((dataset, VOID.classPartition, class_partition))
+        g.add((class_partition, VOID['class'], term(c)))
+        g.add((class_partition, VOID.distinctSubjects, Literal(count)))
+
+    # 2_3 property partitions with the class of their subjects
+    for (p, stype), (triples, scount) in stats['propertySubjectClasses'].items():
+        property_partition = add_property_partition(g, dataset, term(p), triples)
+        class_partition = BNode()
+        g.add((property_partition, VOID.classPartition, class_partition))
+        g.add((class_partition, VOID['class'], term(stype)))
+        g.add((class_partition, VOID.distinctSubjects, Literal(scount)))
+
+    # 2_4 property partitions with the class of their objects
+    for (p, otype), (triples, ocount) in stats['propertyObjectClasses'].items():
+        property_partition = add_property_partition(g, dataset, term(p), triples)
+        add_object_class_partition(g, property_partition, term(otype), ocount)
+
+    # 2_5 property partitions with literal objects
+    for p, (triples, lcount) in stats['propertyLiterals'].items():
+        property_partition = add_property_partition(g, dataset, term(p), triples)
+        add_object_class_partition(g, property_partition, RDFS.Literal, lcount)
+
+    # 2_6 property partitions with the class of their subjects and objects
+    labelled_classes = set()
+    for (p, stype, otype), (scount, ocount) in stats['subjectObjectClasses'].items():
+        property_partition = add_property_partition(g, dataset, term(p))
+        class_partition = BNode()
+        g.add((property_partition, VOID.classPartition, class_partition))
+        g.add((class_partition, VOID['class'], term(stype)))
+        g.add((class_partition, VOID.distinctSubjects, Literal(scount)))
+        add_object_class_partition(g, property_partition, term(otype), ocount)
+        labelled_classes.update([stype, otype])
+    for c in labelled_classes:
+        for label in stats['labels'].get(c, []):
+            g.add((term(c), RDFS.label, term(label)))
+    return g
+
+
+def add_property_partition(g, dataset, property_uri, triples=None):
+    property_partition = BNode()
+    g.add((dataset, VOID.propertyPartition, property_partition))
+    g.add((property_partition, VOID.property, property_uri))
+    if triples is not None:
+        g.add((property_partition, VOID.triples, Literal(triples)))
+    return property_partition
+
+
+def add_object_class_partition(g, property_partition, class_uri, distinct_objects):
+    object_partition = BNode()
+    g.add((property_partition, VOID_EXT.objectClassPartition, object_partition))
+    g.add((object_partition, VOID['class'], class_uri))
+    g.add((object_partition, VOID.distinctObjects, Literal(distinct_objects)))
+
+
+def generate_hcls_from_files(rdf_files, dataset_uri, g=None):
+    """Compute HCLS metadata for N-Triples files, without loading them in a SPARQL endpoint"""
+    stats = compute_hcls_stats(rdf_files)
+    return hcls_stats_to_rdf(stats, dataset_uri, g)
+
+
+def generate_approximate_hcls_from_files(rdf_files, dataset_uri, error=0.02, g=None):
+    """Compute HCLS metadata for N-Triples files, estimating the distinct counts with HyperLogLog sketches"""
+    stats = compute_approximate_hcls_stats(lambda: iter_file_triples(rdf_files),
+        lambda: (triple for triple in iter_file_triples(rdf_files) if triple[1] == RDF_TYPE), error)
+    return hcls_stats_to_rdf(stats, dataset_uri, g)
@@ -0,0 +1,56 @@
+import time
+import zlib
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# HTTP status codes considered transient, the request is retried
+RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(pool_size=10):
+    """Get a requests session shared by the whole process, keeping connections alive in a pool"""
+    with _sessions_lock:
+        if pool_size not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[pool_size] = session
+        return _sessions[pool_size]
+
+
+def iter_file_chunks(file_path, compress=False, chunk_size=1024 * 1024):
+    """Read a file by chunks, optionally compressing them with gzip on the fly"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    if compressor:
+        yield compressor.flush()
+
+
+def request_with_retry(method, url, retries=3, backoff_factor=1, body_factory=None, pool_size=10, **kwargs):
+    """Send a request with the pooled session, retrying connection errors and transient 5xx errors
+    with an exponential backoff (backoff_factor * 2^attempt seconds).
+    body_factory is called at each attempt to get a new streamed body, since a stream can not be sent twice
+    """
+    for attempt in range(retries + 1):
+        if body_factory:
+            kwargs['data'] = body_factory()
+        try:
+            resp = get_session(pool_size).request(method, url, **kwargs)
+            if resp.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                return resp
+            print('⚠️  ' + method + ' ' + url + ' returned ' + str(resp.status_code) + ', retrying')
+        except requests.exceptions.ConnectionError as e:
+            if attempt == retries:
+                raise e
+            print('⚠️  ' + method + ' ' + url + ' connection failed, retrying: ' + str(e))
+        time.sleep(backoff_factor * (2 ** attempt))
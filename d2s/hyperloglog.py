@@ -0,0 +1,61 @@
+"""HyperLogLog sketches to estimate distinct counts with a fixed memory, and merge them.
+A sketch is a bytearray of 2^precision registers, the precision is chosen from the target relative error"""
+import math
+import hashlib
+
+MIN_PRECISION = 4
+MAX_PRECISION = 18
+
+
+def precision_for_error(error):
+    """Smallest precision giving a relative standard error of at most error (1.04 / sqrt(2^precision))"""
+    if error <= 0 or error >= 1:
+        raise Exception("Invalid error for the HyperLogLog sketches: " + str(error) + ". Use a number between 0 and 1, e.g. 0.02")
+    precision = math.ceil(math.log2((1.04 / error) ** 2))
+    return min(MAX_PRECISION, max(MIN_PRECISION, precision))
+
+
+def new_sketch(error=0.02):
+    return bytearray(1 << precision_for_error(error))
+
+
+def sketch_error(sketch):
+    """Relative standard error of the estimations of a sketch"""
+    return 1.04 / math.sqrt(len(sketch))
+
+
+def hash_term(term):
+    """64 bits hash of a RDF term, stable between runs (unlike the python hash of strings)"""
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def add_hash(sketch, term_hash):
+    """Add the 64 bits hash of an element to a sketch"""
+    precision = len(sketch).bit_length() - 1
+    index = term_hash >> (64 - precision)
+    remaining_bits = 64 - precision
+    rank = remaining_bits - (term_hash & ((1 << remaining_bits) - 1)).bit_length() + 1
+    if rank > sketch[index]:
+        sketch[index] = rank
+
+
+def estimate_count(sketch):
+    """Estimate the number of distinct elements added to a sketch"""
+    m = len(sketch)
+    alpha = 0.7213 / (1 + 1.079 / m) if m >= 128 else {16: 0.673, 32: 0.697, 64: 0.709}[m]
+    estimate = alpha * m * m / sum(2.0 ** -register for register in sketch)
+    zeros = sketch.count(0)
+    if estimate <= 2.5 * m and zeros > 0:
+        # Small cardinalities are better estimated with linear counting
+        estimate = m * math.log(m / zeros)
+    return int(round(estimate))
+
+
+def merge_sketches(sketch, other):
+    """Merge a sketch in another one with the same precision, e.g. computed on another page of the data"""
+    if len(sketch) != len(other):
+        raise Exception("Can not merge HyperLogLog sketches with different precisions")
+    for index, register in enumerate(other):
+        if register > sketch[index]:
+            sketch[index] = register
+    return sketch
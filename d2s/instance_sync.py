@@ -0,0 +1,173 @@
+"""Keep the instances of a SPARQL endpoint in sync with a new RDF graph, by batches of subjects.
+The description of each subject (its triples, and the triples of its blank nodes) is hashed from
+canonicalised N-Triples, and the hashes of the synced descriptions are stored in a SQLite database
+in ~/.local/share/d2s, so unchanged subjects are skipped without querying the endpoint.
+For changed subjects, only the triples which differ are deleted and inserted"""
+import os
+import sqlite3
+import hashlib
+from rdflib import Graph, URIRef, BNode
+from rdflib.compare import to_canonical_graph, to_isomorphic, graph_diff
+
+from d2s.ntriples import iter_chunks
+from d2s.utils import get_base_dir
+from d2s.sparql_client import sparql_construct, sparql_update
+
+SYNC_HASHES_FILE = 'sync-hashes.sqlite'
+
+
+def open_sync_hashes(hashes_file=None):
+    """Open the database of the hashes of the synced subjects, and create its table if needed"""
+    if not hashes_file:
+        hashes_file = get_base_dir(SYNC_HASHES_FILE)
+    os.makedirs(os.path.dirname(hashes_file), exist_ok=True)
+    db = sqlite3.connect(hashes_file)
+    db.execute('''CREATE TABLE IF NOT EXISTS subject_hashes (
+        endpoint TEXT NOT NULL,
+        graph TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        PRIMARY KEY (endpoint, graph, subject))''')
+    return db
+
+
+def get_description(g, subject, depth=1):
+    """Triples of a subject, and of the blank nodes it links to, up to depth levels of blank nodes"""
+    description = Graph()
+    nodes = [subject]
+    for level in range(depth + 1):
+        blank_nodes = []
+        for node in nodes:
+            for triple in g.triples((node, None, None)):
+                description.add(triple)
+                if isinstance(triple[2], BNode):
+                    blank_nodes.append(triple[2])
+        nodes = blank_nodes
+    return description
+
+
+def has_blank_node(triple):
+    return any(isinstance(term, BNode) for term in triple)
+
+
+def hash_description(description):
+    """Hash of the canonical N-Triples of a description, blank nodes are relabelled by their content"""
+    if any(has_blank_node(triple) for triple in description):
+        description = to_canonical_graph(description)
+    ntriples = sorted(' '.join(term.n3() for term in triple) for triple in description)
+    return hashlib.sha256('\n'.join(ntriples).encode('utf-8')).hexdigest()
+
+
+def to_ntriples(triples):
+    return '\n'.join(' '.join(term.n3() for term in triple) + ' .' for triple in triples)
+
+
+def in_graph(pattern, graph_uri=None):
+    return 'GRAPH <' + graph_uri + '> { ' + pattern + ' }' if graph_uri else pattern
+
+
+def get_description_pattern(depth=1, blank_nodes_only=False):
+    """Template and pattern of the triples of the subjects ?s, and of their blank nodes up to depth levels
+    :param blank_nodes_only: only match the triples of the subjects to blank nodes
+    """
+    template = '?s ?p ?o0 . '
+    pattern = '?s ?p ?o0 . ' + ('FILTER(isBlank(?o0)) ' if blank_nodes_only else '')
+    for level in range(depth):
+        triple = '?o' + str(level) + ' ?p' + str(level) + ' ?o' + str(level + 1) + ' . '
+        template += triple
+        pattern += 'OPTIONAL { ' + triple + 'FILTER(isBlank(?o' + str(level) + ')) '
+    return template, pattern + '} ' * depth
+
+
+def get_subjects_values(subjects):
+    return 'VALUES ?s { ' + ' '.join('<' + str(subject) + '>' for subject in subjects) + ' } '
+
+
+def get_old_descriptions_query(subjects, graph_uri=None, depth=1):
+    """CONSTRUCT query of the current descriptions of a batch of subjects in the endpoint"""
+    template, pattern = get_description_pattern(depth)
+    return 'CONSTRUCT { ' + template + '} WHERE { ' + get_subjects_values(subjects) + in_graph(pattern, graph_uri) + ' }'
+
+
+def get_sync_update(subjects_changes, graph_uri=None, depth=1):
+    """SPARQL update applying the changes of a batch of subjects: the blank nodes of the subjects
+    whose blank nodes changed are deleted with a pattern (they can not be in DELETE DATA),
+    then the triples removed are deleted, and the new triples inserted"""
+    updates = []
+    replaced_subjects = [subject for subject, changes in subjects_changes.items() if changes['replace_blank_nodes']]
+    if replaced_subjects:
+        template, pattern = get_description_pattern(depth, blank_nodes_only=True)
+        updates.append('DELETE { ' + in_graph(template, graph_uri) + ' } WHERE { ' + get_subjects_values(replaced_subjects) + in_graph(pattern, graph_uri) + ' }')
+    delete_triples = [triple for changes in subjects_changes.values() for triple in changes['delete']]
+    if delete_triples:
+        updates.append('DELETE DATA { ' + in_graph(to_ntriples(delete_triples), graph_uri) + ' }')
+    insert_triples = [triple for changes in subjects_changes.values() for triple in changes['insert']]
+    if insert_triples:
+        updates.append('INSERT DATA { ' + in_graph(to_ntriples(insert_triples), graph_uri) + ' }')
+    return ' ;\n'.join(updates)
+
+
+def get_description_changes(new_description, old_description):
+    """Minimal changes to turn the old description of a subject into the new one, using graph_diff.
+    If the triples with blank nodes changed, all the blank nodes of the subject are replaced"""
+    in_both, in_new, in_old = graph_diff(to_isomorphic(new_description), to_isomorphic(old_description))
+    replace_blank_nodes = any(has_blank_node(triple) for triple in in_new) or any(has_blank_node(triple) for triple in in_old)
+    changes = {
+        'replace_blank_nodes': replace_blank_nodes,
+        'delete': [triple for triple in in_old if not has_blank_node(triple)],
+        'insert': [triple for triple in in_new if not has_blank_node(triple)],
+    }
+    if replace_blank_nodes:
+        # Insert the triples with blank nodes with their labels in the new graph, unique in the update
+        changes['insert'] += [triple for triple in new_description if has_blank_node(triple)]
+    return changes
+
+
+def sync_instances(new_graph, sparql_endpoint, username=None, password=None, subjects=None, graph_uri=None, depth=1,
+        batch_size=100, update_endpoint=None, hashes_file=None):
+    """Sync the descriptions of subjects in a SPARQL endpoint with their descriptions in new_graph, by batches of
+    batch_size subjects: one CONSTRUCT query to get their current descriptions, and one update with the changes.
+    Subjects whose description hash did not change since the last sync are skipped
+    :param subjects: the subjects to sync, all the URI subjects of new_graph by default.
+        Subjects without description in new_graph are deleted from the endpoint
+    :param update_endpoint: URL of the SPARQL update endpoint, if different from sparql_endpoint (e.g. /statements for GraphDB)
+    :return: numbers of subjects unchanged, updated, and of triples deleted and inserted
+    """
+    if subjects is None:
+        subjects = sorted(set(subject for subject in new_graph.subjects() if isinstance(subject, URIRef)))
+    auth = (username, password) if username else None
+    db = open_sync_hashes(hashes_file)
+    stats = { 'unchanged': 0, 'updated': 0, 'deleted': 0, 'inserted': 0 }
+    for batch in iter_chunks((URIRef(subject) for subject in subjects), batch_size):
+        new_descriptions = {}
+        new_hashes = {}
+        for subject in batch:
+            new_descriptions[subject] = get_description(new_graph, subject, depth)
+            new_hashes[subject] = hash_description(new_descriptions[subject])
+        stored_hashes = dict(db.execute('SELECT subject, hash FROM subject_hashes WHERE endpoint = ? AND graph = ? AND subject IN ('
+            + ','.join('?' * len(batch)) + ')', [sparql_endpoint, graph_uri or ''] + [str(subject) for subject in batch]).fetchall())
+        changed_subjects = [subject for subject in batch if stored_hashes.get(str(subject)) != new_hashes[subject]]
+        stats['unchanged'] += len(batch) - len(changed_subjects)
+        if not changed_subjects:
+            continue
+
+        old_graph = Graph()
+        old_graph.parse(data=sparql_construct(sparql_endpoint, get_old_descriptions_query(changed_subjects, graph_uri, depth), auth), format='turtle')
+        subjects_changes = {}
+        for subject in changed_subjects:
+            changes = get_description_changes(new_descriptions[subject], get_description(old_graph, subject, depth))
+            if changes['delete'] or changes['insert'] or changes['replace_blank_nodes']:
+                subjects_changes[subject] = changes
+                stats['deleted'] += len(changes['delete'])
+                stats['inserted'] += len(changes['insert'])
+        if subjects_changes:
+            sparql_update(update_endpoint or sparql_endpoint, get_sync_update(subjects_changes, graph_uri, depth), auth)
+        stats['updated'] += len(subjects_changes)
+        stats['unchanged'] += len(changed_subjects) - len(subjects_changes)
+        db.executemany('INSERT OR REPLACE INTO subject_hashes VALUES (?, ?, ?, ?)',
+            [(sparql_endpoint, graph_uri or '', str(subject), new_hashes[subject]) for subject in changed_subjects])
+        db.commit()
+        print('🔄 Synced ' + str(stats['unchanged'] + stats['updated']) + '/' + str(len(subjects)) + ' subjects: '
+            + str(stats['updated']) + ' updated, ' + str(stats['deleted']) + ' triples deleted, ' + str(stats['inserted']) + ' inserted')
+    db.close()
+    return stats
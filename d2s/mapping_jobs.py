@@ -0,0 +1,146 @@
+import os
+import re
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Only input files bigger than this are split in partitions
+PARTITION_MIN_SIZE = 100 * 1024 * 1024
+PARTITIONS_DIR = '.d2s-partitions'
+# Blank nodes are the subject, or the object after the predicate IRI, so blank nodes labels in literals are not matched
+BLANK_NODE_SUBJECT_REGEX = re.compile(rb'^_:')
+BLANK_NODE_OBJECT_REGEX = re.compile(rb'^(\S+\s+<[^>]*>\s+)_:')
+
+
+def parse_memory(memory):
+    """Convert a java memory size (e.g. 4g, 512m, 2048) to megabytes"""
+    memory_search = re.match(r'^\s*([0-9]+)\s*([kmgt]?)b?\s*$', str(memory), re.IGNORECASE)
+    if not memory_search:
+        raise Exception("Invalid memory size: " + str(memory) + ". Use a number followed by k, m, g or t, e.g. 4g")
+    value = int(memory_search.group(1))
+    unit = memory_search.group(2).lower()
+    if unit == 'k':
+        return max(1, value // 1024)
+    if unit == 'g':
+        return value * 1024
+    if unit == 't':
+        return value * 1024 * 1024
+    return value
+
+
+def split_memory(memory, jobs):
+    """Split a memory budget between jobs running in parallel, e.g. 4g for 2 jobs gives 2048m"""
+    return str(max(1, parse_memory(memory) // max(1, int(jobs)))) + 'm'
+
+
+def run_mapping_job(job):
+    """Run the command of a mapping job in its own working directory
+    :return: the job, with its returncode
+    """
+    print('⚙️  Running mapping job ' + job['name'] + ' in ' + job['cwd'])
+    job['returncode'] = subprocess.run(job['cmd'], shell=True, cwd=job['cwd']).returncode
+    if job['returncode'] != 0:
+        print('❌ Mapping job ' + job['name'] + ' failed with exit code ' + str(job['returncode']))
+    return job
+
+
+def run_mapping_jobs(jobs, max_workers=1):
+    """Run mapping jobs in parallel, each in its own working directory instead of changing the process cwd
+    :return: the jobs, in the same order, with their returncode
+    """
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+        return list(executor.map(run_mapping_job, jobs))
+
+
+def split_tabular_file(file_path, output_files):
+    """Split a CSV or TSV file in len(output_files) partitions of consecutive rows, repeating the header in each.
+    The file is streamed line by line, and CSV rows with quoted line breaks are never split
+    :return: the number of partitions created, which can be lower if the file has few rows
+    """
+    quoted = file_path.lower().endswith('.csv')
+    partition_size = os.path.getsize(file_path) / len(output_files)
+    partitions_count = 0
+    with open(file_path, 'rb') as f:
+        header = f.readline()
+        output = None
+        written_bytes = 0
+        in_quotes = False
+        for line in f:
+            if output is None:
+                output = open(output_files[partitions_count], 'wb')
+                output.write(header)
+                partitions_count += 1
+                written_bytes = 0
+            output.write(line)
+            written_bytes += len(line)
+            if quoted and line.count(b'"') % 2 == 1:
+                # An odd number of quotes opens or closes a quoted field spanning multiple lines
+                in_quotes = not in_quotes
+            if not in_quotes and written_bytes >= partition_size and partitions_count < len(output_files):
+                output.close()
+                output = None
+        if output is not None:
+            output.close()
+    return partitions_count
+
+
+def partition_mapping_job(job, partitions, sources, data_dir='data', min_size=PARTITION_MIN_SIZE):
+    """Split the input file of a mapping job in partitions, and create one job per partition,
+    each running in its own working directory with its partition of the input file.
+    Only mappings with a single CSV or TSV source are partitioned, since joins between sources would be broken
+    :return: the list of jobs to run, which is [job] if the mapping can not be partitioned
+    """
+    if len(sources) != 1 or not sources[0].lower().endswith(('.csv', '.tsv')):
+        return [job]
+    source_path = os.path.join(data_dir, sources[0])
+    if not os.path.exists(source_path) or os.path.getsize(source_path) < min_size:
+        return [job]
+
+    partitions_dir = os.path.abspath(os.path.join(data_dir, PARTITIONS_DIR, job['name']))
+    shutil.rmtree(partitions_dir, ignore_errors=True)
+    partition_dirs = [os.path.join(partitions_dir, str(i)) for i in range(partitions)]
+    for partition_dir in partition_dirs:
+        os.makedirs(os.path.join(partition_dir, os.path.dirname(sources[0])), exist_ok=True)
+    print('✂️  Splitting ' + source_path + ' in ' + str(partitions) + ' partitions for the mapping ' + job['name'])
+    partitions_count = split_tabular_file(source_path, [os.path.join(partition_dir, sources[0]) for partition_dir in partition_dirs])
+
+    partition_jobs = []
+    for i, partition_dir in enumerate(partition_dirs[:partitions_count]):
+        # Files required in the working directory of the mapper, such as the functions jar, are linked in each partition
+        for filename in os.listdir(data_dir):
+            if filename.endswith('.jar'):
+                os.symlink(os.path.abspath(os.path.join(data_dir, filename)), os.path.join(partition_dir, filename))
+        partition_jobs.append(dict(job,
+            name=job['name'] + ' [' + str(i + 1) + '/' + str(partitions_count) + ']',
+            cwd=partition_dir,
+            output=os.path.join(partition_dir, 'output.nt'),
+            partitionOf=job['name']))
+    return partition_jobs
+
+
+def prefix_blank_nodes(statement, prefix):
+    """Add a prefix to the labels of the blank nodes of a N-Triples statement (as bytes)"""
+    if b'_:' not in statement:
+        return statement
+    statement = BLANK_NODE_SUBJECT_REGEX.sub(b'_:' + prefix, statement)
+    return BLANK_NODE_OBJECT_REGEX.sub(lambda match: match.group(1) + b'_:' + prefix, statement)
+
+
+def merge_partition_jobs(job, partition_jobs):
+    """Concatenate the N-Triples outputs of the partitions of a mapping job in its output file,
+    and delete the partitions working directories.
+    The blank nodes labels are prefixed by the partition number, since each partition is mapped
+    separately and the same label in 2 partitions is not the same blank node
+    :return: the job, with its returncode
+    """
+    failed_jobs = [partition_job for partition_job in partition_jobs if partition_job['returncode'] != 0]
+    job['returncode'] = failed_jobs[0]['returncode'] if failed_jobs else 0
+    if job['returncode'] == 0:
+        with open(job['output'], 'wb') as output:
+            for i, partition_job in enumerate(partition_jobs):
+                prefix = b'p' + str(i + 1).encode('utf-8') + b'x'
+                with open(partition_job['output'], 'rb') as f:
+                    for statement in f:
+                        output.write(prefix_blank_nodes(statement, prefix))
+        shutil.rmtree(os.path.dirname(partition_jobs[0]['cwd']), ignore_errors=True)
+    return job
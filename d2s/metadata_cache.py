@@ -0,0 +1,107 @@
+"""Cache of the results of the HCLS metadata queries, in a SQLite database in ~/.local/share/d2s
+Results are keyed by endpoint, graph and query, and only reused if the fingerprint of the graph did not change.
+And journal of the queries completed by an analysis, to resume it after a crash"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+from d2s.utils import get_base_dir
+
+METADATA_CACHE_FILE = 'metadata-cache.sqlite'
+# Default maximum size of the cached results, the least recently used are evicted above it
+METADATA_CACHE_SIZE = 100 * 1024 * 1024
+
+
+def open_metadata_cache(cache_file=None):
+    """Open the metadata cache database, and create its table if needed"""
+    if not cache_file:
+        cache_file = get_base_dir(METADATA_CACHE_FILE)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    db = sqlite3.connect(cache_file)
+    db.execute('''CREATE TABLE IF NOT EXISTS query_results (
+        endpoint TEXT NOT NULL,
+        graph TEXT NOT NULL,
+        query_hash TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        results TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL,
+        PRIMARY KEY (endpoint, graph, query_hash))''')
+    return db
+
+
+def get_query_hash(sparql_query):
+    return hashlib.sha256(sparql_query.encode('utf-8')).hexdigest()
+
+
+def get_cached_results(db, endpoint, graph, sparql_query, fingerprint):
+    """Get the cached results of a query, if the graph fingerprint did not change
+    :return: the list of Turtle results, or None if not in the cache
+    """
+    query_hash = get_query_hash(sparql_query)
+    row = db.execute('SELECT results FROM query_results WHERE endpoint = ? AND graph = ? AND query_hash = ? AND fingerprint = ?',
+        (endpoint, graph, query_hash, fingerprint)).fetchone()
+    if row is None:
+        return None
+    db.execute('UPDATE query_results SET last_used = ? WHERE endpoint = ? AND graph = ? AND query_hash = ?',
+        (time.time(), endpoint, graph, query_hash))
+    db.commit()
+    return json.loads(row[0])
+
+
+def store_results(db, endpoint, graph, sparql_query, fingerprint, results_list, max_size=METADATA_CACHE_SIZE):
+    """Store the results of a query, replacing the results for a previous fingerprint of the graph,
+    then evict the least recently used results until the cache is smaller than max_size bytes"""
+    results = json.dumps([r.decode('utf-8') if isinstance(r, bytes) else r for r in results_list])
+    db.execute('INSERT OR REPLACE INTO query_results VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (endpoint, graph, get_query_hash(sparql_query), fingerprint, results, len(results), time.time()))
+    total_size = db.execute('SELECT COALESCE(SUM(size), 0) FROM query_results').fetchone()[0]
+    if total_size > max_size:
+        for rowid, size in db.execute('SELECT rowid, size FROM query_results ORDER BY last_used').fetchall():
+            if total_size <= max_size:
+                break
+            db.execute('DELETE FROM query_results WHERE rowid = ?', (rowid,))
+            total_size -= size
+    db.commit()
+
+
+def read_journal(journal_file, endpoint):
+    """Index the queries completed in a journal for an endpoint, and truncate the last entry if it has been
+    partially written by a crash, so new entries can be appended
+    :return: dict of (graph, query hash) to the offset of their entry in the journal
+    """
+    journal_index = {}
+    if not os.path.exists(journal_file):
+        return journal_index
+    offset = 0
+    with open(journal_file, 'rb') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            if entry['endpoint'] == endpoint:
+                journal_index[(entry['graph'], entry['query'])] = offset
+            offset += len(line)
+    os.truncate(journal_file, offset)
+    return journal_index
+
+
+def get_journal_results(journal_file, offset):
+    """Read the results of a completed query from the journal, only when needed to keep memory low"""
+    with open(journal_file, 'rb') as f:
+        f.seek(offset)
+        return json.loads(f.readline())['results']
+
+
+def write_journal_entry(journal, endpoint, graph, sparql_query, results_list):
+    """Append the results of a completed query to the journal, and flush them to disk"""
+    journal.write(json.dumps({
+        'endpoint': endpoint,
+        'graph': graph,
+        'query': get_query_hash(sparql_query),
+        'results': [r.decode('utf-8') if isinstance(r, bytes) else r for r in results_list],
+    }) + '\n')
+    journal.flush()
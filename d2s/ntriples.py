@@ -0,0 +1,101 @@
+"""Streaming helpers to process N-Triples and N-Quads files line by line,
+without loading the whole file in a rdflib Graph"""
+import os
+import gzip
+import heapq
+import shutil
+import tempfile
+
+# Number of statements sorted in memory before being written to a temporary file
+SORT_BUFFER_SIZE = 1000000
+
+
+def open_rdf_file(file_path, mode='rt'):
+    """Open a N-Triples or N-Quads file, compressed with gzip if its name ends with .gz"""
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, mode, encoding='utf-8')
+    return open(file_path, mode, encoding='utf-8')
+
+
+def iter_statements(file_path):
+    """Iterate over the statements of a N-Triples or N-Quads file, skipping empty lines and comments"""
+    with open_rdf_file(file_path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def iter_chunks(statements, chunks_size):
+    """Group an iterator of statements in lists of at most chunks_size statements"""
+    chunk = []
+    for statement in statements:
+        chunk.append(statement)
+        if len(chunk) >= chunks_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def sort_unique_statements(input_files, output_file, buffer_size=SORT_BUFFER_SIZE):
+    """Merge N-Triples files in one sorted file without duplicate statements, with an external sort:
+    chunks of buffer_size statements are sorted in memory and written to temporary files,
+    which are then merged, so memory use does not depend on the size of the files.
+    Blank nodes labels are not renamed, so they are shared between the input files, like with cat
+    :return: number of statements written and number of duplicates removed
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='.d2s-sort-', dir=os.path.dirname(output_file) or '.')
+    try:
+        run_files = []
+        read_count = 0
+        for input_file in input_files:
+            for chunk in iter_chunks(iter_statements(input_file), buffer_size):
+                read_count += len(chunk)
+                run_file = os.path.join(tmp_dir, str(len(run_files)) + '.nt')
+                with open(run_file, 'w', encoding='utf-8') as f:
+                    f.writelines(statement + '\n' for statement in sorted(set(chunk)))
+                run_files.append(run_file)
+
+        write_count = 0
+        run_handles = [open(run_file, 'r', encoding='utf-8') for run_file in run_files]
+        try:
+            with open_rdf_file(output_file, 'wt') as output:
+                previous = None
+                for statement in heapq.merge(*run_handles):
+                    if statement != previous:
+                        output.write(statement)
+                        write_count += 1
+                        previous = statement
+        finally:
+            for run_handle in run_handles:
+                run_handle.close()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return { 'statements': write_count, 'duplicates': read_count - write_count }
+
+
+def has_blank_node(statement):
+    """If a N-Triples statement has a blank node (literals containing ' _:' are also matched)"""
+    return statement.startswith('_:') or ' _:' in statement
+
+
+def iter_sorted_diff(old_file, new_file):
+    """Compare two sorted N-Triples files without duplicates (as written by sort_unique_statements)
+    with a single merge pass, so memory use does not depend on the size of the files
+    :return: iterator of ('-', statement) for the statements removed, and ('+', statement) for the statements added
+    """
+    old_statements = iter_statements(old_file)
+    new_statements = iter_statements(new_file)
+    old = next(old_statements, None)
+    new = next(new_statements, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old < new):
+            yield '-', old
+            old = next(old_statements, None)
+        elif old is None or new < old:
+            yield '+', new
+            new = next(new_statements, None)
+        else:
+            old = next(old_statements, None)
+            new = next(new_statements, None)
@@ -2,21 +2,27 @@ import os
 import glob
 from rdflib import Graph, Literal, RDF, XSD, URIRef, Namespace
 from rdflib.namespace import RDFS, DC, DCTERMS, VOID, DCAT
-from SPARQLWrapper import SPARQLWrapper, TURTLE, POST, JSON, JSONLD
-import requests
-from dateutil.parser import parse as parsedate
 import shutil
 import stat
 from urllib.parse import urlparse
 import pandas as pd 
 # import datetime
-from datetime import datetime, timezone
 # import pathlib
 import re
+import time
 
-from d2s.utils import init_d2s_java, get_base_dir, get_parse_format, get_yaml_config
-from d2s.sparql_operations import insert_graph_in_sparql_endpoint, java_upload_files
+from d2s.utils import init_d2s_java, get_base_dir, get_parse_format
+from d2s.project_config import get_project_config
+from d2s.sparql_operations import insert_graph_in_sparql_endpoint, java_upload_files, publish_ntriples_delta
 from d2s.generate_metadata import generate_hcls_from_sparql
+from d2s.hcls_stats import generate_approximate_hcls_from_files
+from d2s.download import download_files
+from d2s.http_client import request_with_retry, iter_file_chunks
+from d2s.ntriples import sort_unique_statements
+from d2s.mapping_jobs import run_mapping_jobs, split_memory, parse_memory, partition_mapping_job, merge_partition_jobs
+from d2s.defaults import SNAPSHOTS_KEEP
+from d2s.snapshot_store import create_snapshot, load_snapshots_index, get_snapshot_file, set_published_snapshot
+from d2s.build_cache import load_build_cache, save_build_cache, get_file_hash, get_rml_sources, get_mapping_cache_key, get_merged_cache_key, cached_output_exists, restore_cached_outputs, store_cached_outputs
 
 D2S = Namespace("https://w3id.org/d2s/vocab/")
 
@@ -44,11 +50,34 @@ def execute_script(script):
     os.system(script_cmd)
 
 
-def load_rdf_to_ldp(upload_file, upload_mimetype, ldp_url, ldp_slug, endpoint_user, endpoint_password):
+def load_rdf_to_ldp(upload_file, upload_mimetype, ldp_url, ldp_slug, endpoint_user, endpoint_password, compress=False):
+    """Upload a RDF file to the Virtuoso LDP, streaming the file with the pooled HTTP session.
+    Transient 5xx errors are retried with backoff, and an exception is raised if the upload failed
+    :return: status code, bytes sent and throughput of the upload
+    """
     print('📤 Loading the RDF file ' + upload_file + ' to the graph ' + ldp_url + '/' + ldp_slug)
-    load_cmd = 'curl -u ' + endpoint_user + ':' + endpoint_password + ' --data-binary @' + upload_file + ' -H "Accept: ' + upload_mimetype + '" -H "Content-type: ' + upload_mimetype + '" -H "Slug: ' + ldp_slug + '" ' + ldp_url
-    print(load_cmd)
-    os.system(load_cmd)
+    headers = { 'Accept': upload_mimetype, 'Content-Type': upload_mimetype, 'Slug': ldp_slug }
+    # Files already compressed with gzip are sent as is
+    compress_body = compress and not upload_file.endswith('.gz')
+    if compress or upload_file.endswith('.gz'):
+        headers['Content-Encoding'] = 'gzip'
+    upload_stats = { 'bytes': 0 }
+    def upload_body():
+        upload_stats['bytes'] = 0
+        for chunk in iter_file_chunks(upload_file, compress_body):
+            upload_stats['bytes'] += len(chunk)
+            yield chunk
+
+    start_time = time.time()
+    resp = request_with_retry('POST', ldp_url, body_factory=upload_body, headers=headers, auth=(endpoint_user, endpoint_password))
+    run_time = max(time.time() - start_time, 0.001)
+    upload_stats['status'] = resp.status_code
+    upload_stats['bytes_per_second'] = upload_stats['bytes'] / run_time
+    if resp.status_code >= 400:
+        raise Exception('Upload of ' + upload_file + ' to ' + ldp_url + ' failed with status ' + str(resp.status_code) + ': ' + resp.text[:500])
+    print('📤 Uploaded ' + str(round(upload_stats['bytes'] / 1000000, 2)) + ' MB in ' + str(round(run_time, 2)) + 's ('
+        + str(round(upload_stats['bytes_per_second'] / 1000000, 2)) + ' MB/s), status ' + str(resp.status_code))
+    return upload_stats
 
 
 # TODO: unfinished example of a workflow to build entities and associations
@@ -76,7 +105,7 @@ def sio_builder_csv(filename, row):
             sioBuilder.to_rdf()
 
 
-def process_datasets_metadata(input_file=None, dryrun=True, staging=True, sample=0, report=False, memory='4g', rmlstreamer_run=False):
+def process_datasets_metadata(input_file=None, dryrun=True, staging=True, sample=0, report=False, memory='4g', rmlstreamer_run=False, jobs=1, partitions=1, gzip_output=False, delta=False, keep_snapshots=SNAPSHOTS_KEEP, local_stats=False):
     """Read a RDF metadata file with infos about datasets, check if the dataset exist in the project SPARQL endpoint
     Download the data if new"""
 
@@ -177,11 +206,12 @@ def process_datasets_metadata(input_file=None, dryrun=True, staging=True, sample
     else:
         versionRegex = None
 
-    prod_endpoint = get_yaml_config('production')['sparql-endpoint']
-    prod_ldp = get_yaml_config('production')['virtuoso-ldp-url']
-    staging_endpoint = get_yaml_config('staging')['sparql-endpoint']
-    if 'virtuoso-ldp-url' in get_yaml_config('staging').keys():
-        staging_ldp = get_yaml_config('staging')['virtuoso-ldp-url']
+    # Loaded and validated before downloading the files, so an invalid d2s.yml fails early
+    config = get_project_config()
+    prod_endpoint = config.production.sparql_endpoint
+    prod_ldp = config.production.virtuoso_ldp_url
+    staging_endpoint = config.staging.sparql_endpoint
+    staging_ldp = config.staging.virtuoso_ldp_url
     endpoint_user = os.getenv('DBA_USER', 'dav')
     endpoint_password = os.getenv('DBA_PASSWORD')
 
@@ -220,14 +250,9 @@ def process_datasets_metadata(input_file=None, dryrun=True, staging=True, sample
 
     # Download file in the data subfolder
     os.chdir('data')
-    skip_global_download = True
-    # Check last modified date, then download and post process scripts defined for each file
+
     for ddl_file in download_file_list:
         ddl_url = ddl_file['downloadUrl']
-        # # Extract filename from URI:
-        # ddl_filename = os.path.basename(urlparse(ddl_url).path)
-        processed_filename = ddl_file['processedFilename']
-        
         if versionRegex:
             # TODO: Extract version, then increment it 
             # and check if new version available
@@ -235,55 +260,21 @@ def process_datasets_metadata(input_file=None, dryrun=True, staging=True, sample
             if version_search:
                 file_version = version_search.group(1)
                 print(file_version)
-                
-
-        skip_download = True
-
-        # Check Last Modified date of the URL to download
-        print('🔎 Checking Last Modified date of file at ' + ddl_url)
-        r = requests.head(ddl_url)
-        if 'last-modified' in r.headers.keys():
-            url_last_modified = r.headers['last-modified']
-            ddl_file['lastModified'] = parsedate(url_last_modified)
-            print('📅 File to download last modified on ' + url_last_modified)
-
-        ## Check if last date updated from SPARQL endpoint is older than the URL Last Modified date
-        # if ddl_file['lastModified'] > date_last_updated:
-        #     print('📥 According to Last Modified date, the remote file to download is newer than the existing local file (' + str(local_file_time) + '). Downloading it.')
-        #     skip_download = False
-        #     skip_global_download = False
-        # elif os.path.exists(processed_filename):
-
-        # Download only if processed file does not exist, is older than the file to ddl, 
-        # or if the file to ddl has no LastModified date
-        if os.path.exists(processed_filename):
-            # If the file to download is newer than existing local file 
-            if 'lastModified' in ddl_file.keys():
-                local_file_time = datetime.fromtimestamp(os.path.getmtime(processed_filename), timezone.utc)
-                if ddl_file['lastModified'] > local_file_time:
-                    print('📥 According to Last Modified date, the remote file to download is newer than the existing local file (' + str(local_file_time) + '). Downloading it.')
-                    skip_download = False
-                    skip_global_download = False
-                else: 
-                    print('⏩️ According to Last Modified date, the remote file to download is not newer than the existing local file at data/' + processed_filename + ' (' + str(local_file_time) + '). Skipping download.')
-            else:
-                print('📥 No Last Modified date for this file. Downloading it.')
-                skip_download = False
-                skip_global_download = False
-        else:
-            print('📥 No existing local file for this file. Downloading it.')
-            skip_download = False
-            skip_global_download = False
 
-        # Run the download and preprocess scripts if download required
-        if not skip_download:
+    # Download the files that changed since the last run in parallel, using the cache in data/.d2s-cache.json
+    download_file_list = download_files(download_file_list, config.resources.download_workers)
+    print('')
+
+    # Then run the download and post process scripts defined for each file, in order
+    skip_global_download = True
+    for ddl_file in download_file_list:
+        if not ddl_file['skipDownload']:
+            skip_global_download = False
             if 'downloadScript' in ddl_file:
                 execute_script(ddl_file['downloadScript'])
-            elif 'downloadUrl' in ddl_file:
-                os.system("wget -qN " + ddl_url)
             if 'postProcessScript' in ddl_file:
                 execute_script(ddl_file['postProcessScript'])
-        print('')
+            print('')
 
     # Run download and post process scripts defined for the whole dataset if at least one file has been downloaded
     if not skip_global_download:
@@ -350,60 +341,127 @@ def process_datasets_metadata(input_file=None, dryrun=True, staging=True, sample
     # Go back to dataset folder to convert YARRML files
     os.chdir('..')
 
+    # Mappings outputs are reused when their YARRRML, RML, functions and input files did not change
+    build_cache = load_build_cache()
+    mapping_outputs = []
+    mapping_keys = []
+    mapping_jobs = []
+
     # For each YARRRML mappings: convert to RML and run mapper
-    for file in glob.glob('*.yarrr.yml'):
+    for file in sorted(glob.glob('*.yarrr.yml')):
         yarrrml_filename = os.fsdecode(file)
         rml_filename = yarrrml_filename.replace('.yarrr.yml', '.rml.ttl')
-        print('🦜 Converting YARRRML mapping '+ yarrrml_filename + ' to RML ' + rml_filename)
         output_filepath = '../output/' + yarrrml_filename.replace('.yarrr.yml', output_file_extension)
-        os.system('yarrrml-parser -i ' + yarrrml_filename + ' -o data/' + rml_filename)
-
-        # Run RML mapper depending on processor given in the metadata file
-        if processor.lower() == 'rmlmapper-java':
-            print('☕️ Running the RML mapper with java to generate the RDF to ' + output_filepath.replace('../', ''))
-            init_d2s_java('rmlmapper')
-            # Change dir to fix issue with rmlmapper requiring to load a .dtd locally when reading DrugBank RML
-            os.chdir('data')
-            # Copy functions jar file in the same folder where we run the rmlmapper to fix issues with finding the functions
-            shutil.copy('../../IdsRmlFunctions.jar', 'IdsRmlFunctions.jar')
-            if 'memory' in get_yaml_config('resources').keys():
-                memory = get_yaml_config('resources')['memory']
-            java_opts = "-Xms" + memory + " -Xmx" + memory
-            rml_cmd = 'java ' + java_opts + ' -jar ' + get_base_dir('rmlmapper.jar') + ' -s ' + rdfSyntax + ' -f ../../functions_ids.ttl -m ' + rml_filename + ' -o ' + output_filepath
-            os.system(rml_cmd)
-            os.chdir('..')
+        mapping_outputs.append(output_filepath.replace('../', ''))
+        mapping_cache = build_cache['mappings'].setdefault(yarrrml_filename, {})
+        yarrrml_hash = get_file_hash(build_cache, yarrrml_filename)
+        if mapping_cache.get('yarrrml') == yarrrml_hash and os.path.exists('data/' + rml_filename):
+            print('⏩️ YARRRML mapping ' + yarrrml_filename + ' unchanged, reusing the RML ' + rml_filename)
+        else:
+            print('🦜 Converting YARRRML mapping '+ yarrrml_filename + ' to RML ' + rml_filename)
+            if os.system('yarrrml-parser -i ' + yarrrml_filename + ' -o data/' + rml_filename) == 0:
+                mapping_cache['yarrrml'] = yarrrml_hash
+
+        # Only the local processors outputs can be reused
+        mapping_key = None
+        if processor.lower() in ['rmlmapper-java', 'rocketrml'] and not rmlstreamer_run and os.path.exists('data/' + rml_filename):
+            mapping_key = get_mapping_cache_key(build_cache, yarrrml_filename, 'data/' + rml_filename, '../functions_ids.ttl',
+                processor=processor.lower(), rdf_syntax=rdfSyntax,
+                functions_jar=get_file_hash(build_cache, '../IdsRmlFunctions.jar'),
+                rocketrml=get_file_hash(build_cache, '../rocketrml.js'))
+        mapping_keys.append(mapping_key)
+        if mapping_key and mapping_cache.get('key') == mapping_key and cached_output_exists(mapping_outputs[-1]):
+            print('⏩️ Mapping ' + yarrrml_filename + ' and its input files unchanged, reusing the previous output ' + mapping_outputs[-1])
+            continue
+        mapping_cache['key'] = None
 
         # if processor.lower() == 'rmlstreamer':
         if rmlstreamer_run:
             print('🐿️ Running the RMLStreamer')
             rmlstreamer_dataset_path = os.getcwd()
-            parallel_cores = str(get_yaml_config('resources')['flink-cores'])
+            if not config.resources.flink_cores:
+                raise Exception("Define the flink-cores in the resources of d2s.yml to run the RMLStreamer")
+            parallel_cores = str(config.resources.flink_cores)
             os.chdir('data')
             rmlstreamer_cmd = '/opt/flink/bin/flink run -p ' + parallel_cores + ' -c io.rml.framework.Main /opt/flink/lib/RMLStreamer.jar toFile -m ' + rmlstreamer_dataset_path + '/data/' + rml_filename + ' -o ' + rmlstreamer_dataset_path + '/output/output-' + dataset_id + '.nt --job-name "RMLStreamer Bio2KG - ' + dataset_id + '"'
             os.system(rmlstreamer_cmd)
             os.chdir('..')
-            
-
-        if processor.lower() == 'rocketrml':
-            print('🚀 Running RocketRML with NodeJS to generate the RDF to ' + output_filepath)
-            os.chdir('data')
-            nodejs_memory='2048'
-            if 'nodejs-memory' in get_yaml_config('resources').keys():
-                nodejs_memory = str(get_yaml_config('resources')['nodejs-memory'])
+        if processor.lower() in ['rmlmapper-java', 'rocketrml'] and not rmlstreamer_run:
+            # Local mappers run in data/ to fix issue with rmlmapper requiring to load a .dtd locally when reading DrugBank RML
+            mapping_jobs.append({ 'name': yarrrml_filename, 'rml': os.path.abspath('data/' + rml_filename),
+                'output': os.path.abspath(mapping_outputs[-1]), 'cwd': 'data', 'key': mapping_key })
+
+    # Large CSV and TSV inputs can be split in partitions, each mapped by a different job
+    run_jobs = []
+    for job in mapping_jobs:
+        if int(partitions) > 1 and rdfSyntax == 'ntriples':
+            run_jobs += partition_mapping_job(job, int(partitions), get_rml_sources(job['rml']))
+        else:
+            run_jobs.append(job)
+
+    # Run the local RML mappers in parallel, the memory is split between the jobs running at the same time
+    parallel_jobs = max(1, min(int(jobs), len(run_jobs)))
+    if processor.lower() == 'rmlmapper-java' and len(run_jobs) > 0:
+        init_d2s_java('rmlmapper')
+        # Copy functions jar file in the same folder where we run the rmlmapper to fix issues with finding the functions
+        shutil.copy('../IdsRmlFunctions.jar', 'data/IdsRmlFunctions.jar')
+        if config.resources.memory:
+            memory = str(config.resources.memory)
+        job_memory = split_memory(memory, parallel_jobs)
+        java_opts = "-Xms" + job_memory + " -Xmx" + job_memory
+        for job in run_jobs:
+            print('☕️ Running the RML mapper with java to generate the RDF to ' + os.path.relpath(job['output']))
+            job['cmd'] = 'java ' + java_opts + ' -jar ' + get_base_dir('rmlmapper.jar') + ' -s ' + rdfSyntax + ' -f ' + os.path.abspath('../functions_ids.ttl') + ' -m ' + job['rml'] + ' -o ' + job['output']
+
+    if processor.lower() == 'rocketrml':
+        nodejs_memory = str(parse_memory(split_memory(str(config.resources.nodejs_memory) + 'm', parallel_jobs)))
+        for job in run_jobs:
+            print('🚀 Running RocketRML with NodeJS to generate the RDF to ' + os.path.relpath(job['output']))
             # Try to increase node memory to 2G for large files with --max_old_space_size=2048
-            os.system(f'node --max_old_space_size={nodejs_memory} ../../rocketrml.js -m {rml_filename} -o {output_filepath}')
-            os.chdir('..')
-
-    # TO CHECK: concatenate produced nt files in 1 file if multiple files
-    list_ntriples = glob.glob('output/*.nt')
-    if len(list_ntriples) > 1:
-        print('🗃️ Concatenate ntriples files: ' + ', '.join(list_ntriples))
-        output_filepath = 'output/' + dataset_id +'.nt'
-        if os.path.exists(output_filepath):
-            os.system('rm ' + output_filepath)
-        os.system('cat output/*.nt > ' + output_filepath)
-        os.system('ls output/*.nt | grep -v ' + output_filepath + ' | xargs rm')
-        # os.system('ls *.nt | grep -v ' + dataset_id + '.nt' + ' | parallel rm')
+            job['cmd'] = f"node --max_old_space_size={nodejs_memory} {os.path.abspath('../rocketrml.js')} -m {job['rml']} -o {job['output']}"
+
+    run_jobs = run_mapping_jobs(run_jobs, parallel_jobs)
+    for job in mapping_jobs:
+        partition_jobs = [run_job for run_job in run_jobs if run_job.get('partitionOf') == job['name']]
+        if partition_jobs:
+            print('🗃️ Concatenate the outputs of the ' + str(len(partition_jobs)) + ' partitions of ' + job['name'])
+            merge_partition_jobs(job, partition_jobs)
+        if job['returncode'] == 0:
+            build_cache['mappings'][job['name']]['key'] = job['key']
+
+    # Merge produced nt files in 1 sorted file without duplicates if multiple files
+    output_filepath = 'output/' + dataset_id + ('.nt.gz' if gzip_output else '.nt')
+    merged_key = get_merged_cache_key(mapping_keys)
+    # If the output is a merged file, already sorted without duplicates
+    merged_output = False
+    if len(mapping_outputs) > 1 and merged_key and build_cache.get('merged') == merged_key and os.path.exists(output_filepath):
+        print('⏩️ Mappings outputs unchanged, reusing the merged file ' + output_filepath)
+        merged_output = True
+    else:
+        restore_cached_outputs(mapping_outputs)
+        merged_outputs = ['output/' + dataset_id + '.nt', 'output/' + dataset_id + '.nt.gz']
+        list_ntriples = [ntriples_file for ntriples_file in glob.glob('output/*.nt') if ntriples_file not in merged_outputs]
+        if len(list_ntriples) > 1:
+            print('🗃️ Merging ntriples files and removing duplicates: ' + ', '.join(list_ntriples))
+            # Remove previous merged files, with or without gzip
+            for previous_output in merged_outputs:
+                if os.path.exists(previous_output):
+                    os.remove(previous_output)
+            merge_stats = sort_unique_statements(list_ntriples, output_filepath)
+            print('🗃️ ' + str(merge_stats['statements']) + ' statements written to ' + output_filepath + ', '
+                + str(merge_stats['duplicates']) + ' duplicates removed')
+            # Keep the mappings outputs in the build cache, instead of deleting them
+            store_cached_outputs(list_ntriples)
+            build_cache['merged'] = merged_key
+            merged_output = True
+    save_build_cache(build_cache)
+
+    # Store the N-Triples published as a new version of the dataset, to compare and roll back versions, see d2s snapshot
+    snapshot = None
+    ntriples_outputs = glob.glob('output/*.nt') + glob.glob('output/*.nt.gz')
+    if ntriples_outputs and keep_snapshots > 0 and not dryrun:
+        snapshot = create_snapshot(dataset_id, ntriples_outputs, keep=keep_snapshots,
+            presorted=merged_output and ntriples_outputs == [output_filepath])
 
     if dryrun:
         print('✅ Dry run completed: RDF generated, but not published')
@@ -445,18 +503,35 @@ def process_datasets_metadata(input_file=None, dryrun=True, staging=True, sample
         # Iterates the output file to upload them to the Virtuoso LDP triplestore
         # Should be only one turtle or ntriples file because the LDP create 1 graph per file
         for output_file in glob.glob('output/*'):
-            # Load the RDF output file to the Virtuoso LDP DAV
-            # Existing file is overwritten automatically at upload
-            load_rdf_to_ldp(output_file, output_file_mimetype, update_ldp, dataset_id, endpoint_user, endpoint_password)
+            published_snapshot = None
+            if snapshot and output_file.endswith(('.nt', '.nt.gz')):
+                published_snapshot = load_snapshots_index(dataset_id)['published']
+            delta_stats = None
+            if delta and not published_snapshot and output_file.endswith(('.nt', '.nt.gz')):
+                print('⚠️  No snapshot of ' + dataset_id + ' has been published yet, publishing the whole file instead of the changes')
+            if delta and published_snapshot:
+                # Only publish the statements which changed since the snapshot of the last publication
+                delta_stats = publish_ntriples_delta(get_snapshot_file(dataset_id, { 'id': published_snapshot }),
+                    get_snapshot_file(dataset_id, snapshot), update_endpoint, endpoint_user, endpoint_password, dataset_graph)
+            if delta_stats is None:
+                # Load the RDF output file to the Virtuoso LDP DAV
+                # Existing file is overwritten automatically at upload
+                load_rdf_to_ldp(output_file, output_file_mimetype, update_ldp, dataset_id, endpoint_user, endpoint_password, gzip_output)
+            if snapshot and output_file.endswith(('.nt', '.nt.gz')):
+                set_published_snapshot(dataset_id, snapshot['id'])
             
             # TODO: then run d2s metadata to get HCLS metadata and upload it in the dataset metadata graph
             # And compare new version metadata to the current version in production
             # generate_hcls_from_sparql(sparql_endpoint, rdf_distribution_uri, metadata_type, graph)
-            g_metadata = generate_hcls_from_sparql(update_endpoint, dataset_graph, 'hcls', dataset_graph)
+            if local_stats and output_file.endswith(('.nt', '.nt.gz')):
+                # Estimate the HCLS metadata from the N-Triples file, instead of querying the whole graph in the endpoint
+                g_metadata = generate_approximate_hcls_from_files([output_file], dataset_graph)
+            else:
+                g_metadata = generate_hcls_from_sparql(update_endpoint, dataset_graph, 'hcls', dataset_graph)
             
             g_metadata.serialize(destination=output_metadata_file, format='turtle', indent=4)
 
-            load_rdf_to_ldp(output_metadata_file, "Accept: text/turtle", update_ldp, metadata_slug, endpoint_user, endpoint_password)
+            load_rdf_to_ldp(output_metadata_file, 'text/turtle', update_ldp, metadata_slug, endpoint_user, endpoint_password)
             
             # TODO: handle dataset_version
             
@@ -0,0 +1,97 @@
+"""Configuration of a d2s project, in the d2s.yml file at the root of its git repository.
+The file is found, parsed and validated against the resources/d2s-config.schema.json schema
+only once per process, then the production, staging and resources settings are accessed as attributes"""
+import os
+import re
+import json
+from functools import lru_cache
+from collections import namedtuple
+
+from d2s.utils import get_git_path
+
+CONFIG_FILE = 'd2s.yml'
+CONFIG_SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'd2s-config.schema.json')
+
+EndpointConfig = namedtuple('EndpointConfig', ['sparql_endpoint', 'virtuoso_ldp_url'])
+ResourcesConfig = namedtuple('ResourcesConfig', ['memory', 'nodejs_memory', 'flink_cores', 'download_workers'])
+ProjectConfig = namedtuple('ProjectConfig', ['production', 'staging', 'resources', 'base_url', 'prefixes', 'yaml'])
+
+# Default resources, memory is None to use the --memory of d2s run
+RESOURCES_DEFAULTS = { 'memory': None, 'nodejs-memory': 2048, 'flink-cores': None, 'download-workers': 4 }
+JSON_TYPES = { 'object': dict, 'array': list, 'string': str, 'integer': int, 'number': (int, float), 'boolean': bool }
+
+
+@lru_cache(maxsize=None)
+def find_config_file(cwd):
+    """Path of the d2s.yml file of the git repository containing the folder cwd"""
+    return get_git_path(CONFIG_FILE)
+
+
+def get_project_config():
+    """Get the config of the project the user is in, see load_project_config"""
+    return load_project_config(find_config_file(os.getcwd()))
+
+
+@lru_cache(maxsize=None)
+def load_project_config(config_file):
+    """Load and validate a d2s.yml config file, the config is cached, so the file is only read once
+    :return: a ProjectConfig, with the parsed YAML in yaml
+    """
+    import yaml
+    if not os.path.isfile(config_file):
+        raise Exception("No " + CONFIG_FILE + " config file found at the root of the git repository, create one with d2s init")
+    with open(config_file) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader) or {}
+    errors = validate_config(config)
+    if errors:
+        raise Exception("Invalid config file " + config_file + ":\n  - " + '\n  - '.join(errors))
+    resources = { **RESOURCES_DEFAULTS, **config.get('resources', {}) }
+    return ProjectConfig(
+        production=EndpointConfig(config['production']['sparql-endpoint'], config['production']['virtuoso-ldp-url']),
+        staging=EndpointConfig(config['staging']['sparql-endpoint'], config['staging']['virtuoso-ldp-url']),
+        resources=ResourcesConfig(resources['memory'], resources['nodejs-memory'], resources['flink-cores'], resources['download-workers']),
+        base_url=config['base-url'],
+        prefixes=config.get('prefixes', {}),
+        yaml=config,
+    )
+
+
+def validate_config(config, schema_file=CONFIG_SCHEMA_FILE):
+    """Validate a config with jsonschema if installed, or with get_schema_errors
+    :return: the list of errors, with the path of the invalid value
+    """
+    with open(schema_file) as f:
+        schema = json.load(f)
+    try:
+        import jsonschema
+    except ImportError:
+        return get_schema_errors(config, schema, schema)
+    return [format_schema_error(list(error.absolute_path), error.message)
+        for error in jsonschema.Draft7Validator(schema).iter_errors(config)]
+
+
+def format_schema_error(path, message):
+    return '/'.join(str(key) for key in path) + ': ' + message if path else message
+
+
+def get_schema_errors(value, schema, root_schema, path=[]):
+    """Check a value against the subset of JSON schema used by the d2s config schema, when jsonschema is not installed:
+    $ref to the $defs, type, properties, required, pattern and minimum"""
+    if '$ref' in schema:
+        schema = root_schema['$defs'][schema['$ref'].split('/')[-1]]
+    types = schema['type'] if isinstance(schema.get('type'), list) else [schema['type']] if 'type' in schema else []
+    if types and not any(isinstance(value, JSON_TYPES[json_type]) and not (isinstance(value, bool) and json_type != 'boolean') for json_type in types):
+        return [format_schema_error(path, repr(value) + ' is not of type ' + ', '.join(repr(json_type) for json_type in types))]
+    errors = []
+    if isinstance(value, dict):
+        for key in schema.get('required', []):
+            if key not in value:
+                errors.append(format_schema_error(path, repr(key) + ' is a required property'))
+        for key, property_schema in schema.get('properties', {}).items():
+            if key in value:
+                errors += get_schema_errors(value[key], property_schema, root_schema, path + [key])
+    if isinstance(value, str) and 'pattern' in schema and not re.search(schema['pattern'], value):
+        errors.append(format_schema_error(path, repr(value) + ' does not match ' + repr(schema['pattern'])))
+    if isinstance(value, (int, float)) and not isinstance(value, bool) and 'minimum' in schema and value < schema['minimum']:
+        errors.append(format_schema_error(path, str(value) + ' is less than the minimum of ' + str(schema['minimum'])))
+    return errors
@@ -0,0 +1,57 @@
+"""Timings of the SPARQL queries sent to compute metadata, logged in a JSON lines file
+with one entry per query: time, endpoint, graph, query name, source of the results, status,
+wall time in seconds, bytes received and triples parsed"""
+import json
+import time
+
+from d2s.defaults import SLOWEST_QUERIES_COUNT
+
+
+def open_query_log(log_file):
+    return open(log_file, 'w')
+
+
+def timed(function, *args):
+    """Run a function and measure its wall time, the exception raised is returned instead of raised,
+    so the time spent by failing queries (e.g. timeouts) is also measured
+    :return: (result, start time, wall time in seconds, exception)
+    """
+    start_time = time.time()
+    start = time.perf_counter()
+    try:
+        return function(*args), start_time, time.perf_counter() - start, None
+    except Exception as e:
+        return None, start_time, time.perf_counter() - start, e
+
+
+def log_query(query_log, entry):
+    """Append an entry to the query log, and flush it to keep the timings if the analysis crashes"""
+    query_log.write(json.dumps(entry) + '\n')
+    query_log.flush()
+
+
+def read_query_log(log_file):
+    with open(log_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def print_slowest_queries(entries, count=SLOWEST_QUERIES_COUNT):
+    """Print the queries which took the most time in total over all graphs, and the slowest single queries"""
+    per_query = {}
+    for entry in entries:
+        stats = per_query.setdefault(entry['query'], { 'runs': 0, 'failed': 0, 'wall_time': 0.0, 'max_time': 0.0, 'bytes': 0 })
+        stats['runs'] += 1
+        stats['failed'] += 1 if entry['status'] == 'failed' else 0
+        stats['wall_time'] += entry['wall_time']
+        stats['max_time'] = max(stats['max_time'], entry['wall_time'])
+        stats['bytes'] += entry['bytes']
+
+    print('⏱️  Queries taking the most time:')
+    print(f"{'Total (s)':>10} {'Max (s)':>9} {'Runs':>6} {'Failed':>6} {'Bytes':>12}  Query")
+    for query, stats in sorted(per_query.items(), key=lambda item: item[1]['wall_time'], reverse=True)[:count]:
+        print(f"{stats['wall_time']:>10.2f} {stats['max_time']:>9.2f} {stats['runs']:>6} {stats['failed']:>6} {stats['bytes']:>12}  {query}")
+
+    print('⏱️  Slowest queries:')
+    print(f"{'Time (s)':>10} {'Triples':>9} {'Status':>8}  Query  Graph")
+    for entry in sorted(entries, key=lambda entry: entry['wall_time'], reverse=True)[:count]:
+        print(f"{entry['wall_time']:>10.2f} {entry['triples']:>9} {entry['status']:>8}  {entry['query']}  {entry['graph']}")
@@ -0,0 +1,164 @@
+"""Local store of the versions of the N-Triples produced by d2s run, in the .d2s-snapshots folder, keyed by
+dataset id and run timestamp. Snapshots are sorted without duplicates and compressed with gzip, so two versions
+are compared with a single merge pass (see d2s.ntriples.iter_sorted_diff), and an index.json per dataset
+records the statements count of each snapshot, and the snapshot last published"""
+import os
+import gzip
+import json
+import shutil
+from datetime import datetime
+
+from d2s.defaults import SNAPSHOTS_KEEP
+from d2s.ntriples import sort_unique_statements, iter_sorted_diff, iter_statements, open_rdf_file
+
+SNAPSHOTS_DIR = '.d2s-snapshots'
+SNAPSHOTS_INDEX = 'index.json'
+SNAPSHOT_EXTENSION = '.nt.gz'
+
+
+def get_snapshots_folder(dataset_id, snapshots_dir=SNAPSHOTS_DIR):
+    return os.path.join(snapshots_dir, dataset_id)
+
+
+def load_snapshots_index(dataset_id, snapshots_dir=SNAPSHOTS_DIR):
+    """Load the index of the snapshots of a dataset, from the oldest to the latest"""
+    index_file = os.path.join(get_snapshots_folder(dataset_id, snapshots_dir), SNAPSHOTS_INDEX)
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            return json.load(f)
+    return { 'snapshots': [], 'published': None }
+
+
+def save_snapshots_index(dataset_id, index, snapshots_dir=SNAPSHOTS_DIR):
+    index_file = os.path.join(get_snapshots_folder(dataset_id, snapshots_dir), SNAPSHOTS_INDEX)
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(index_file + '.tmp', index_file)
+
+
+def get_snapshot(index, snapshot_id=None):
+    """Get a snapshot from the index: the latest by default, or the last published with 'published'"""
+    if snapshot_id is None:
+        return index['snapshots'][-1] if index['snapshots'] else None
+    if snapshot_id == 'published':
+        snapshot_id = index['published']
+    for snapshot in index['snapshots']:
+        if snapshot['id'] == snapshot_id:
+            return snapshot
+    raise Exception("Snapshot not found: " + str(snapshot_id) + ". Use one of " + ', '.join(snapshot['id'] for snapshot in index['snapshots']))
+
+
+def get_snapshot_file(dataset_id, snapshot, snapshots_dir=SNAPSHOTS_DIR):
+    return os.path.join(get_snapshots_folder(dataset_id, snapshots_dir), snapshot['id'] + SNAPSHOT_EXTENSION)
+
+
+def create_snapshot(dataset_id, input_files, snapshots_dir=SNAPSHOTS_DIR, keep=SNAPSHOTS_KEEP, presorted=False):
+    """Store the N-Triples files produced by a run as a new snapshot of the dataset, named by the run timestamp.
+    No snapshot is added if the statements did not change since the latest snapshot.
+    With presorted, the single input file is already sorted without duplicates (e.g. merged by d2s run), so it is only compressed
+    :return: the snapshot in the index
+    """
+    index = load_snapshots_index(dataset_id, snapshots_dir)
+    snapshot_id = datetime.now().strftime('%Y%m%dT%H%M%S')
+    if any(snapshot['id'] == snapshot_id for snapshot in index['snapshots']):
+        snapshot_id += '-' + str(len(index['snapshots']))
+    snapshot = { 'id': snapshot_id }
+    snapshot_file = get_snapshot_file(dataset_id, snapshot, snapshots_dir)
+    # Written with a temporary name, compressed with gzip as its extension ends with .gz
+    tmp_file = os.path.join(os.path.dirname(snapshot_file), '.tmp-' + os.path.basename(snapshot_file))
+    os.makedirs(os.path.dirname(snapshot_file), exist_ok=True)
+    if presorted and len(input_files) == 1:
+        sort_stats = copy_statements(input_files[0], tmp_file)
+    else:
+        sort_stats = sort_unique_statements(input_files, tmp_file)
+
+    latest = get_snapshot(index)
+    if latest and next(iter_sorted_diff(get_snapshot_file(dataset_id, latest, snapshots_dir), tmp_file), None) is None:
+        os.remove(tmp_file)
+        print('⏩️ Statements unchanged since the snapshot ' + latest['id'] + ' of ' + dataset_id)
+        return latest
+    os.replace(tmp_file, snapshot_file)
+    snapshot['statements'] = sort_stats['statements']
+    snapshot['size'] = os.path.getsize(snapshot_file)
+    index['snapshots'].append(snapshot)
+    save_snapshots_index(dataset_id, index, snapshots_dir)
+    print('📸 Snapshot ' + snapshot_id + ' of ' + dataset_id + ' stored with ' + str(snapshot['statements']) + ' statements')
+    prune_snapshots(dataset_id, keep, snapshots_dir)
+    return snapshot
+
+
+def copy_statements(input_file, output_file):
+    """Copy the statements of a N-Triples file, compressed with gzip if the output file name ends with .gz
+    :return: the number of statements written
+    """
+    statements = 0
+    with open_rdf_file(output_file, 'wt') as output:
+        for statement in iter_statements(input_file):
+            output.write(statement + '\n')
+            statements += 1
+    return { 'statements': statements }
+
+
+def prune_snapshots(dataset_id, keep=SNAPSHOTS_KEEP, snapshots_dir=SNAPSHOTS_DIR):
+    """Remove the oldest snapshots of a dataset to only keep the latest ones, and the published one
+    :return: the ids of the snapshots removed
+    """
+    index = load_snapshots_index(dataset_id, snapshots_dir)
+    removed = [snapshot for snapshot in index['snapshots'][:max(len(index['snapshots']) - keep, 0)]
+        if snapshot['id'] != index['published']]
+    for snapshot in removed:
+        snapshot_file = get_snapshot_file(dataset_id, snapshot, snapshots_dir)
+        if os.path.exists(snapshot_file):
+            os.remove(snapshot_file)
+        index['snapshots'].remove(snapshot)
+    if removed:
+        save_snapshots_index(dataset_id, index, snapshots_dir)
+    return [snapshot['id'] for snapshot in removed]
+
+
+def set_published_snapshot(dataset_id, snapshot_id, snapshots_dir=SNAPSHOTS_DIR):
+    """Record the snapshot published in the triplestore, used to only publish the changes with --delta"""
+    index = load_snapshots_index(dataset_id, snapshots_dir)
+    index['published'] = get_snapshot(index, snapshot_id)['id']
+    save_snapshots_index(dataset_id, index, snapshots_dir)
+
+
+def diff_snapshots(dataset_id, old_id, new_id=None, snapshots_dir=SNAPSHOTS_DIR):
+    """Compare 2 snapshots of a dataset, the latest snapshot by default
+    :return: iterator of ('-', statement) for the statements removed, and ('+', statement) for the statements added
+    """
+    index = load_snapshots_index(dataset_id, snapshots_dir)
+    return iter_sorted_diff(get_snapshot_file(dataset_id, get_snapshot(index, old_id), snapshots_dir),
+        get_snapshot_file(dataset_id, get_snapshot(index, new_id), snapshots_dir))
+
+
+def restore_snapshot(dataset_id, snapshot_id, output_file, snapshots_dir=SNAPSHOTS_DIR):
+    """Write the statements of a snapshot to an output file, compressed with gzip if its name ends with .gz"""
+    snapshot = get_snapshot(load_snapshots_index(dataset_id, snapshots_dir), snapshot_id)
+    snapshot_file = get_snapshot_file(dataset_id, snapshot, snapshots_dir)
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    if output_file.endswith('.gz'):
+        shutil.copyfile(snapshot_file, output_file)
+    else:
+        with gzip.open(snapshot_file, 'rb') as source, open(output_file, 'wb') as output:
+            shutil.copyfileobj(source, output)
+    print('⏪ Snapshot ' + snapshot['id'] + ' of ' + dataset_id + ' restored to ' + output_file)
+
+
+def publish_snapshot(dataset_id, snapshot_id, update_endpoint, username, password, graph_uri, snapshots_dir=SNAPSHOTS_DIR):
+    """Publish a snapshot of a dataset, e.g. to roll back to a previous version, by only sending the statements
+    which differ from the snapshot last published, see d2s.sparql_operations.publish_ntriples_delta"""
+    from d2s.sparql_operations import publish_ntriples_delta
+    index = load_snapshots_index(dataset_id, snapshots_dir)
+    snapshot = get_snapshot(index, snapshot_id)
+    if not index['published']:
+        raise Exception("No snapshot of " + dataset_id + " has been published yet, publish it with d2s run --publish")
+    delta_stats = publish_ntriples_delta(get_snapshot_file(dataset_id, get_snapshot(index, 'published'), snapshots_dir),
+        get_snapshot_file(dataset_id, snapshot, snapshots_dir), update_endpoint, username, password, graph_uri)
+    if delta_stats is None:
+        raise Exception("Statements with blank nodes changed between the snapshots " + index['published'] + " and " + snapshot['id']
+            + ", restore the snapshot and publish the whole file")
+    set_published_snapshot(dataset_id, snapshot['id'], snapshots_dir)
+    print('✅ Snapshot ' + snapshot['id'] + ' of ' + dataset_id + ' published to ' + graph_uri)
+    return delta_stats
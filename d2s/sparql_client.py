@@ -0,0 +1,74 @@
+"""Client used for all the requests to SPARQL endpoints: pooled keep-alive connections, timeouts,
+retries of transient errors with an exponential backoff, gzip compressed responses,
+and a limit of the number of concurrent requests sent to each endpoint"""
+import threading
+import requests
+
+from d2s.defaults import SPARQL_CLIENT_DEFAULTS
+from d2s.http_client import request_with_retry
+
+# Settings of the client, changed for all commands with the d2s options, see configure_sparql_client
+SPARQL_CLIENT_SETTINGS = dict(SPARQL_CLIENT_DEFAULTS)
+
+_endpoint_semaphores = {}
+_endpoint_semaphores_lock = threading.Lock()
+
+
+def configure_sparql_client(**settings):
+    """Change the settings of the SPARQL client, e.g. configure_sparql_client(read_timeout=60)"""
+    for key, value in settings.items():
+        if key not in SPARQL_CLIENT_SETTINGS:
+            raise Exception("Invalid SPARQL client setting: " + key + ". Use one of " + ', '.join(SPARQL_CLIENT_SETTINGS.keys()))
+        if value is not None:
+            SPARQL_CLIENT_SETTINGS[key] = value
+
+
+def get_endpoint_semaphore(sparql_endpoint):
+    """Semaphore limiting the number of concurrent requests to an endpoint, shared by all threads"""
+    with _endpoint_semaphores_lock:
+        if sparql_endpoint not in _endpoint_semaphores:
+            _endpoint_semaphores[sparql_endpoint] = threading.BoundedSemaphore(SPARQL_CLIENT_SETTINGS['max_connections'])
+        return _endpoint_semaphores[sparql_endpoint]
+
+
+def sparql_request(method, sparql_endpoint, headers={}, **kwargs):
+    """Send a request to a SPARQL endpoint with the shared settings, and raise an exception
+    with the beginning of the response if it failed"""
+    headers = { 'Accept-Encoding': 'gzip', **headers }
+    with get_endpoint_semaphore(sparql_endpoint):
+        resp = request_with_retry(method, sparql_endpoint, SPARQL_CLIENT_SETTINGS['retries'], SPARQL_CLIENT_SETTINGS['backoff_factor'],
+            pool_size=SPARQL_CLIENT_SETTINGS['max_connections'], headers=headers,
+            timeout=(SPARQL_CLIENT_SETTINGS['connect_timeout'], SPARQL_CLIENT_SETTINGS['read_timeout']), **kwargs)
+    if resp.status_code >= 400:
+        raise requests.HTTPError(method + ' ' + sparql_endpoint + ' returned ' + str(resp.status_code) + ': ' + resp.text[:500], response=resp)
+    return resp
+
+
+def sparql_select(sparql_endpoint, query, auth=None):
+    """Run a SELECT query, sent with POST to support long queries
+    :return: the list of results bindings
+    """
+    resp = sparql_request('POST', sparql_endpoint, data={ 'query': query }, auth=auth,
+        headers={ 'Accept': 'application/sparql-results+json' })
+    return resp.json()['results']['bindings']
+
+
+def sparql_construct(sparql_endpoint, query, auth=None):
+    """Run a CONSTRUCT query
+    :return: the Turtle results, as bytes
+    """
+    resp = sparql_request('POST', sparql_endpoint, data={ 'query': query }, auth=auth,
+        headers={ 'Accept': 'text/turtle' })
+    return resp.content
+
+
+def sparql_update(sparql_endpoint, update, auth=None):
+    """Run a SPARQL update, e.g. INSERT DATA or DELETE DATA"""
+    return sparql_request('POST', sparql_endpoint, data={ 'update': update }, auth=auth)
+
+
+def post_rdf(sparql_endpoint, data, mimetype, auth=None, params={}, body_factory=None):
+    """Post RDF data to the statements of a repository (works for GraphDB and RDF4J),
+    use body_factory instead of data to stream a body, see d2s.http_client.request_with_retry"""
+    return sparql_request('POST', sparql_endpoint, data=data, auth=auth, params=params, body_factory=body_factory,
+        headers={ 'Content-Type': mimetype })
@@ -1,11 +1,23 @@
 import os
+import time
 import pathlib
 import glob
+import click
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from rdflib import Graph, Literal, RDF, XSD, URIRef, Namespace
 from rdflib.namespace import RDFS, DC, DCTERMS, VOID
-from SPARQLWrapper import SPARQLWrapper, TURTLE, POST, JSON, JSONLD
+from rdflib.util import guess_format
 from d2s.utils import init_d2s_java, get_base_dir
-import requests
+from d2s.ntriples import iter_statements, iter_chunks, iter_sorted_diff, has_blank_node
+from d2s.http_client import iter_file_chunks
+from d2s.sparql_client import post_rdf, sparql_update
+from d2s.instance_sync import sync_instances
+
+# Line-based RDF formats that can be streamed by chunks of statements
+NTRIPLES_MIMETYPES = {
+    '.nt': 'application/n-triples',
+    '.nq': 'application/n-quads',
+}
 
 # DATASET_NAMESPACE = 'https://w3id.org/d2s/dataset/'
 
@@ -22,19 +34,43 @@ import requests
 # IDOT = Namespace("http://identifiers.org/idot/")
 # FOAF = Namespace("http://xmlns.com/foaf/0.1/")
 
-def sparql_insert_files(file_pattern, sparql_endpoint, username, password, graph_uri=None, chunks_size=1000):
-    for file_path in glob.glob(file_pattern):
-        print('INSERT file: ' + file_path)
-        try:
-            insert_results = insert_file_in_sparql_endpoint(file_path, sparql_endpoint, username, password, graph_uri, chunks_size)
-        except Exception as e:
-            print('Error with INSERT of file: ' + file_path)
-            print(e)
+def sparql_insert_files(file_pattern, sparql_endpoint, username, password, graph_uri=None, chunks_size=1000, workers=1):
+    """Insert the files matching the pattern, parsing and uploading workers files concurrently,
+    then print the number of statements inserted per second and the files which failed
+    :return: dict of the files which failed to their error
+    """
+    files = sorted(glob.glob(file_pattern))
+    failed_files = {}
+    statements_count = 0
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+        futures = { executor.submit(insert_file_in_sparql_endpoint, file_path, sparql_endpoint, username, password, graph_uri, chunks_size): file_path
+            for file_path in files }
+        with click.progressbar(as_completed(futures), length=len(files), label='INSERT ' + str(len(files)) + ' files') as bar:
+            for future in bar:
+                try:
+                    statements_count += future.result()['statements'] or 0
+                except Exception as e:
+                    failed_files[futures[future]] = e
+    duration = time.time() - start
+    print('✅ Inserted ' + str(statements_count) + ' statements from ' + str(len(files) - len(failed_files)) + ' files in '
+        + str(round(duration, 1)) + 's (' + str(int(statements_count / duration) if duration else 0) + ' statements/s)')
+    if failed_files:
+        print('❌ INSERT failed for ' + str(len(failed_files)) + ' files:')
+        for file_path, error in failed_files.items():
+            print('  - ' + file_path + ': ' + str(error))
+    return failed_files
 
 
 def insert_file_in_sparql_endpoint(file_path, sparql_endpoint, username, password, graph_uri=None, chunks_size=1000):
+    """Insert a RDF file in a SPARQL endpoint, raise an exception if the insert failed
+    :return: number of statements and requests sent
+    """
     # file_path = 'file.ttl'
     filename, file_extension = os.path.splitext(file_path)
+    if file_extension in NTRIPLES_MIMETYPES:
+        # N-Triples and N-Quads are streamed, to not load the whole file in memory
+        return insert_ntriples_file_in_sparql_endpoint(file_path, sparql_endpoint, username, password, graph_uri, chunks_size)
     file_format = ''
     # Get file format for rdflib.parse based on file extension
     if file_extension in ['.trig', '.n3']:
@@ -51,11 +87,56 @@ def insert_file_in_sparql_endpoint(file_path, sparql_endpoint, username, passwor
         file_format = 'nquads'
     g = Graph()
     g.parse(file_path, format=file_format)
-    insert_results = insert_graph_in_sparql_endpoint(g, sparql_endpoint, username, password, graph_uri, chunks_size)
-    return insert_results
+    post_rdf_to_sparql_endpoint(str(g.serialize(format='turtle')).encode('utf-8'), 'text/turtle',
+        sparql_endpoint, username, password, graph_uri)
+    return { 'statements': len(g), 'chunks': 1 }
+
+def insert_ntriples_file_in_sparql_endpoint(file_path, sparql_endpoint, username, password, graph_uri=None, chunks_size=1000):
+    """Stream a N-Triples or N-Quads file to a SPARQL endpoint, reading it line by line
+    and posting batches of chunks_size statements (-1 to post the whole file in one request).
+    Blank nodes are scoped to each request, so files with blank nodes are always posted in one request,
+    otherwise the statements of a blank node in different chunks would create different nodes
+    :return: number of statements and requests sent
+    """
+    mimetype = NTRIPLES_MIMETYPES[os.path.splitext(file_path)[1]]
+    chunks_size = int(chunks_size)
+    if chunks_size > 0 and any(has_blank_node(statement) for statement in iter_statements(file_path)):
+        print('⚠️  ' + file_path + ' has blank nodes, it is loaded in one request instead of chunks of ' + str(chunks_size) + ' statements')
+        chunks_size = -1
+    if chunks_size < 1:
+        # Load all in one shot, the file is streamed without reading it in memory, and its lines counted
+        lines_count = [0]
+        def count_file_chunks():
+            lines_count[0] = 0
+            for chunk in iter_file_chunks(file_path):
+                lines_count[0] += chunk.count(b'\n')
+                yield chunk
+        post_rdf_to_sparql_endpoint(None, mimetype, sparql_endpoint, username, password, graph_uri,
+            body_factory=count_file_chunks)
+        return { 'statements': lines_count[0], 'chunks': 1 }
+
+    statements_count = 0
+    chunks_count = 0
+    for chunk in iter_chunks(iter_statements(file_path), chunks_size):
+        post_rdf_to_sparql_endpoint(('\n'.join(chunk) + '\n').encode('utf-8'), mimetype,
+            sparql_endpoint, username, password, graph_uri)
+        statements_count += len(chunk)
+        chunks_count += 1
+        print('Inserted ' + str(statements_count) + ' statements from ' + file_path)
+    return { 'statements': statements_count, 'chunks': chunks_count }
+
+
+def post_rdf_to_sparql_endpoint(data, mimetype, sparql_endpoint, username, password, graph_uri=None, body_factory=None):
+    """Post RDF data to a SPARQL endpoint using basic auth (works for GraphDB)
+    The graph is passed as RDF4J context parameter. Raise an exception if the request failed"""
+    params = {}
+    if graph_uri:
+        params['context'] = '<' + graph_uri + '>'
+    return post_rdf(sparql_endpoint, data, mimetype, (username, password), params, body_factory)
+
 
 def insert_graph_in_sparql_endpoint(g, sparql_endpoint, username, password, graph_uri=None, chunks_size=1000, operation='INSERT'):
-    """Insert rdflib graph in a Update SPARQL endpoint using SPARQLWrapper
+    """Insert rdflib graph in a SPARQL endpoint, posted as Turtle with the client of d2s.sparql_client
     :param g: rdflib graph to insert
     :return: SPARQL update query result
     """
@@ -65,11 +146,7 @@ def insert_graph_in_sparql_endpoint(g, sparql_endpoint, username, password, grap
 
     # Post RDF file to SPARQL endpoint using basic auth (works for GraphDB)
     try:
-        resp = requests.post(f"{sparql_endpoint}", 
-            headers={ 'Content-Type': 'text/turtle' },
-            data=str(g.serialize(format='turtle')).encode('utf-8'),
-            auth=(username, password),
-        )
+        resp = post_rdf(sparql_endpoint, str(g.serialize(format='turtle')).encode('utf-8'), 'text/turtle', (username, password))
         print(resp)
     except Exception as e:
         print(e)
@@ -123,55 +200,55 @@ def insert_graph_in_sparql_endpoint(g, sparql_endpoint, username, password, grap
     
 
 def sparql_update_instance(subject_uri, new_graph, sparql_endpoint, username, password, depth=1, graph_uri=None):
-    """Run a construct query to get a RDF graph with all triples for the subject_uri
-    Use rdflib to compare this graph to the new graph we just generated
-    If diff then delete old instance statements and insert new_graph
+    """Update the triples of the subject_uri in the SPARQL endpoint to match the new graph we just generated,
+    only the triples which changed are deleted and inserted, see d2s.instance_sync.sync_instances to sync many subjects
     """
-    # https://rdflib.readthedocs.io/en/4.0/_modules/rdflib/compare.html
-    from rdflib.compare import IsomorphicGraph, graph_diff
-    print('Starting graph diff for ' + str(subject_uri))
-    construct_array = []
-    where_array = []
-    current_depth = 0
-    while current_depth <= depth:
-        pattern = '?o' + str(current_depth) + ' ?p' + str(current_depth) + ' ?o' + str(current_depth+1) + ' . '
-        construct_array.append(pattern)
-        where_array.append('OPTIONAL{' + pattern + '} ')
-        current_depth += 1
-        
-    construct_query = "CONSTRUCT { ?s ?p ?o1 . " + ' '.join(construct_array) + " } WHERE { ?s ?p ?o . " + ' '.join(where_array) + " FILTER(?s = <" + subject_uri + ">) }"
-    # CONSTRUCT { ?s ?p ?o1 . ?o1 ?p1 ?o2 . } WHERE { ?s ?p ?o . OPTIONAL{?o1 ?p1 ?o2 .} FILTER... }
-    print(sparql_endpoint)
-    print(construct_query)
-    
-    # new_graph.setReturnFormat(TURTLE)
-    # results = new_graph.query(construct_query).convert().decode('utf-8')
-    results = new_graph.query(construct_query)
-    new_g = IsomorphicGraph()
-    new_g.parse(data=results.serialize(format='xml'), format=TURTLE)
-    print('New G done')
-    
-    old_g = IsomorphicGraph()
-    sparql = SPARQLWrapper(sparql_endpoint)
-    # sparql.setQuery(construct_query)
-    sparql.setReturnFormat(TURTLE)
-    results = sparql.query(construct_query).convert().decode('utf-8')
-    old_g.parse(data=results, format="turtle")
-    print('Old G done')
-    # Write RDF to file
-    # with open(self.get_dir(output_file), 'w') as f:
-    #     f.write(results)
-
-    if new_g == old_g:
+    stats = sync_instances(new_graph, sparql_endpoint, username, password, [subject_uri], graph_uri, depth)
+    if stats['updated'] == 0:
         print('Graph already up to date for file ' + str(subject_uri))
         return 'uptodate'
-    else:
-        print('Update graph for file ' + str(subject_uri))
-        in_both, in_first, in_second = graph_diff(new_g, old_g)
-        # Delete old graph and insert new graph
-        insert_graph_in_sparql_endpoint(old_g, sparql_endpoint, username, password, graph_uri, 4500, 'DELETE')
-        insert_graph_in_sparql_endpoint(new_graph, sparql_endpoint, username, password, graph_uri, 4500, 'INSERT')
-        return { 'in_both': in_both, 'in_first': in_first, 'in_second': in_second }
+    return stats
+
+
+def sparql_sync_files(file_pattern, sparql_endpoint, username, password, graph_uri=None, depth=1, batch_size=100, update_endpoint=None):
+    """Sync the subjects described in the RDF files matching the pattern with their triples in the SPARQL endpoint"""
+    g = Graph()
+    for file_path in sorted(glob.glob(file_pattern)):
+        g.parse(file_path, format=guess_format(file_path))
+    return sync_instances(g, sparql_endpoint, username, password, None, graph_uri, depth, batch_size, update_endpoint)
+
+def publish_ntriples_delta(snapshot_file, new_file, update_endpoint, username, password, graph_uri, batch_size=10000):
+    """Publish only the statements which changed since the last publication, by comparing the sorted
+    N-Triples snapshot of the previous publication with the new one, see d2s.ntriples.iter_sorted_diff.
+    Changes are sent by batches of batch_size statements with DELETE DATA and INSERT DATA,
+    sending them again is harmless if the publication is interrupted
+    :return: numbers of statements removed and added, or None if statements with blank nodes changed,
+        since they can not be deleted with DELETE DATA, and the whole file needs to be uploaded
+    """
+    changes_count = { '-': 0, '+': 0 }
+    for change, statement in iter_sorted_diff(snapshot_file, new_file):
+        if has_blank_node(statement):
+            print('⚠️  Statements with blank nodes changed, the whole file needs to be published')
+            return None
+        changes_count[change] += 1
+    print('🔀 ' + str(changes_count['-']) + ' statements removed and ' + str(changes_count['+'])
+        + ' added since the last publication in ' + graph_uri)
+
+    batches = { '-': [], '+': [] }
+    def send_batch(change):
+        operation = 'DELETE DATA' if change == '-' else 'INSERT DATA'
+        sparql_update(update_endpoint, operation + ' { GRAPH <' + graph_uri + '> {\n' + '\n'.join(batches[change]) + '\n} }',
+            (username, password))
+        batches[change] = []
+    for change, statement in iter_sorted_diff(snapshot_file, new_file):
+        batches[change].append(statement)
+        if len(batches[change]) >= batch_size:
+            send_batch(change)
+    for change in batches.keys():
+        if batches[change]:
+            send_batch(change)
+    return { 'removed': changes_count['-'], 'added': changes_count['+'] }
+
 
 def java_upload_files(file_pattern, sparql_endpoint, username, password, graph=None):
     """Upload RDF files to a SPARQL endpoint using d2s-sparql-operations Java RDF4J
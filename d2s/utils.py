@@ -1,18 +1,11 @@
 import os
 from pathlib import Path
-import pkg_resources
 import shutil
 import click
-import dotenv 
-import git
-import requests
-import yaml
 # For JSON-LD:
 # from rdflib.serializer import Serializer
 # from rdflib import plugin
 
-from d2s.generate_metadata import create_dataset_prompt
-
 # logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
 def get_git_path(find_file=None):
@@ -36,20 +29,13 @@ def get_git_path(find_file=None):
     # return git_root
 
 def get_yaml_config(key=None):
-    """Return path of the root folder of the git repo the user is in"""
-    yaml_path = get_git_path('d2s.yml')
-    if os.path.isfile(yaml_path):
-        with open(yaml_path) as file:
-            yaml_file = yaml.load(file, Loader=yaml.FullLoader)
-            if not key:
-                return yaml_file
-            else: 
-                if key in yaml_file.keys():
-                    return yaml_file[key]
-                else:
-                    return None
-    else:
-        return {}
+    """Return the config of the project in d2s.yml, or the value of one of its keys.
+    The config is loaded and validated once, see d2s.project_config for typed access"""
+    from d2s.project_config import get_project_config
+    yaml_config = get_project_config().yaml
+    if not key:
+        return yaml_config
+    return yaml_config.get(key)
 
 def get_base_dir(file=''):
     """Base dir (XDG standard) for d2s executables and jar in ~/.local/share/d2s"""
@@ -57,6 +43,7 @@ def get_base_dir(file=''):
 
 def init_d2s_java(init_file=''):
     """Download jar files if not present"""
+    import requests
     os.makedirs(get_base_dir(), exist_ok=True)
     if init_file == 'sparql-operations' and not os.path.isfile(get_base_dir('sparql-operations.jar')):
         print('Downloading sparql-operations.jar in ' + get_base_dir())
@@ -94,6 +81,8 @@ def get_parse_format(input_file):
 # Init project and config
 def init_folder():
     """Initialize a project in the current folder"""
+    import git
+    import pkg_resources
     d2s_repository_url = click.prompt(click.style('[?]', bold=True) + ' Enter the Git repository URL for this project if you already have one (leave empty to use the current git repository, or init a new git repository): ', default="")
 
     # Clone git repo if URL provided
@@ -141,6 +130,8 @@ def init_folder():
 
 def new_dataset():
     """Create a folder to map a new dataset"""
+    import pkg_resources
+    from d2s.generate_metadata import create_dataset_prompt
     # Go to the root of the git repo
     os.chdir(get_git_path())
     # Make sure datasets and .github/workflows folder have been created
@@ -15,7 +15,7 @@ setup(
     # package_dir={'': 'src'},
     package_data={'': [ 'queries/*', 'queries/hcls/*', 'queries/bio2rdf/*', 
                         'templates/*', 'templates/project/*', 'templates/dataset/*',
-                        'templates/dataset/mapping/*', 'templates/dataset/scripts/*']},
+                        'templates/dataset/mapping/*', 'templates/dataset/scripts/*', 'resources/*']},
     # package_data={'': ['queries/**', 
     #                     'templates/**']},
     include_package_data=True,
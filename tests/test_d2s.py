@@ -1,12 +1,37 @@
 from click.testing import CliRunner
 import d2s.__main__ as d2s
 import d2s.generate_metadata as generate_metadata
+import d2s.ntriples as ntriples
+import d2s.download as download
+import d2s.build_cache as build_cache
+import d2s.mapping_jobs as mapping_jobs
+import d2s.http_client as http_client
+import d2s.hcls_stats as hcls_stats
+import d2s.hyperloglog as hyperloglog
+import d2s.metadata_cache as metadata_cache
+import d2s.graph_discovery as graph_discovery
+import d2s.query_log as query_log
+import d2s.sparql_client as sparql_client
+import d2s.sparql_operations as sparql_operations
+import d2s.instance_sync as instance_sync
+import d2s.snapshot_store as snapshot_store
+import d2s.project_config as project_config
+import d2s.defaults as defaults
+import gzip
+import hashlib
+import json
 import os.path
+import sys
+import subprocess
+import time
 
-def test_d2s_init():
+def test_d2s_init(tmp_path, monkeypatch):
    runner = CliRunner()
+   # Run in a temporary folder, to not create the project files in the d2s repository
+   monkeypatch.chdir(tmp_path)
    result_init = runner.invoke(d2s.init, [], input='\n')
    assert not result_init.exception
+   assert os.path.isfile(tmp_path / 'd2s.yml')
    # assert os.path.isfile('README.md')
    # result_dataset = runner.invoke(d2s.new.dataset, [], input='\n')
 #    assert result.output == 'Foo: wau wau\nfoo=wau wau\n'
@@ -14,4 +39,385 @@ def test_d2s_init():
 def test_generate_metadata():
    sparql_endpoint_url = 'https://graphdb.dumontierlab.com/repositories/umids-kg'
    output_metadata = generate_metadata.generate_hcls_from_sparql(sparql_endpoint_url, sparql_endpoint_url, 'hcls', None)
-   assert len(output_metadata) > 10
\ No newline at end of file
+   assert len(output_metadata) > 10
+
+def test_ntriples_chunks(tmp_path):
+   nt_file = tmp_path / 'test.nt'
+   nt_file.write_text('# comment\n' + ''.join(f'<http://s/{i}> <http://p> "{i}" .\n' for i in range(25)) + '\n')
+   chunks = list(ntriples.iter_chunks(ntriples.iter_statements(str(nt_file)), 10))
+   assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+   assert chunks[0][0] == '<http://s/0> <http://p> "0" .'
+
+
+def test_download_conditional_headers(tmp_path):
+   processed_file = tmp_path / 'data.csv'
+   assert download.get_conditional_headers({'etag': '"abc"'}, str(processed_file)) == {}
+   processed_file.write_text('id,name\n')
+   headers = download.get_conditional_headers({'etag': '"abc"', 'lastModified': 'Wed, 21 Oct 2015 07:28:00 GMT'}, str(processed_file))
+   assert headers == {'If-None-Match': '"abc"', 'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+   assert 'If-Modified-Since' in download.get_conditional_headers(None, str(processed_file))
+
+
+class StubResponse:
+   def __init__(self, status_code, body=b''):
+      self.status_code = status_code
+      self.headers = { 'etag': '"' + hashlib.sha1(body).hexdigest() + '"' }
+      self.body = body
+   def __enter__(self):
+      return self
+   def __exit__(self, *args):
+      pass
+   def iter_content(self, chunk_size):
+      return [self.body]
+   def raise_for_status(self):
+      if self.status_code >= 400:
+         raise Exception(str(self.status_code) + ' error')
+
+class StubSession:
+   def __init__(self):
+      self.requests = []
+   def request(self, method, url, **kwargs):
+      self.requests.append((method, url, kwargs['timeout']))
+      # The first files complete last
+      time.sleep(0.1 if url.endswith('file1.csv') else 0)
+      if url.endswith('missing.csv'):
+         return StubResponse(404)
+      return StubResponse(200, url.encode('utf-8'))
+
+def test_download_files_parallel(tmp_path, monkeypatch):
+   session = StubSession()
+   monkeypatch.setattr(http_client, 'get_session', lambda pool_size: session)
+   monkeypatch.chdir(tmp_path)
+   files = [{ 'downloadUrl': 'http://e/file' + str(i) + '.csv', 'processedFilename': 'file' + str(i) + '.csv' } for i in range(1, 5)]
+   files = download.download_files(files, download_workers=4)
+   assert [ddl_file['processedFilename'] for ddl_file in files] == ['file1.csv', 'file2.csv', 'file3.csv', 'file4.csv']
+   assert all(timeout == download.DOWNLOAD_TIMEOUT for method, url, timeout in session.requests)
+   assert (tmp_path / 'file1.csv').read_text() == 'http://e/file1.csv'
+   # The files downloaded are recorded in the cache manifest, even when another download failed
+   files.append({ 'downloadUrl': 'http://e/missing.csv', 'processedFilename': 'missing.csv' })
+   (tmp_path / download.DOWNLOAD_CACHE_FILE).unlink()
+   try:
+      download.download_files(files, download_workers=4)
+      assert False
+   except Exception as e:
+      assert 'http://e/missing.csv' in str(e)
+   assert len(download.load_download_cache(str(tmp_path / download.DOWNLOAD_CACHE_FILE))) == 4
+
+
+def test_build_cache_mapping_key(tmp_path, monkeypatch):
+   monkeypatch.chdir(tmp_path)
+   os.makedirs('data')
+   with open('data/mapping.rml.ttl', 'w') as f:
+      f.write('@prefix rml: <http://semweb.mmlab.be/ns/rml#> .\n<#map> rml:logicalSource [ rml:source "input.csv" ] .\n')
+   with open('data/input.csv', 'w') as f:
+      f.write('id\n1\n')
+   cache = build_cache.load_build_cache()
+   key = build_cache.get_mapping_cache_key(cache, 'mapping.yarrr.yml', 'data/mapping.rml.ttl', 'functions_ids.ttl')
+   assert build_cache.get_rml_sources('data/mapping.rml.ttl') == ['input.csv']
+   assert key == build_cache.get_mapping_cache_key(cache, 'mapping.yarrr.yml', 'data/mapping.rml.ttl', 'functions_ids.ttl')
+   with open('data/input.csv', 'a') as f:
+      f.write('2\n')
+   assert key != build_cache.get_mapping_cache_key(cache, 'mapping.yarrr.yml', 'data/mapping.rml.ttl', 'functions_ids.ttl')
+
+
+def test_split_memory():
+   assert mapping_jobs.parse_memory('4g') == 4096
+   assert mapping_jobs.split_memory('4g', 2) == '2048m'
+   assert mapping_jobs.split_memory('512m', 3) == '170m'
+
+
+def test_split_tabular_file(tmp_path):
+   csv_file = tmp_path / 'input.csv'
+   csv_file.write_text('id,label\n' + ''.join(f'{i},"line\nbreak {i}"\n' for i in range(100)))
+   partitions = [str(tmp_path / f'partition{i}.csv') for i in range(3)]
+   assert mapping_jobs.split_tabular_file(str(csv_file), partitions) == 3
+   rows = []
+   for partition in partitions:
+      with open(partition) as f:
+         lines = f.read().split('\n')
+      assert lines[0] == 'id,label'
+      rows += lines[1:-1]
+   assert len(rows) == 200
+
+
+def test_merge_partition_jobs(tmp_path):
+   partition_jobs = []
+   for i in range(2):
+      os.makedirs(tmp_path / 'partitions' / str(i))
+      output = tmp_path / 'partitions' / str(i) / 'output.nt'
+      output.write_text('_:b0 <http://e/label> "label _:b0" .\n<http://e/s' + str(i) + '> <http://e/p> _:b0 .\n')
+      partition_jobs.append({ 'name': 'job [' + str(i + 1) + '/2]', 'cwd': str(output.parent), 'output': str(output), 'returncode': 0 })
+   job = mapping_jobs.merge_partition_jobs({ 'name': 'job', 'output': str(tmp_path / 'output.nt') }, partition_jobs)
+   assert job['returncode'] == 0
+   assert (tmp_path / 'output.nt').read_text().splitlines() == [
+      '_:p1xb0 <http://e/label> "label _:b0" .', '<http://e/s0> <http://e/p> _:p1xb0 .',
+      '_:p2xb0 <http://e/label> "label _:b0" .', '<http://e/s1> <http://e/p> _:p2xb0 .']
+   assert not os.path.exists(tmp_path / 'partitions')
+
+
+def test_sort_unique_statements(tmp_path):
+   (tmp_path / 'a.nt').write_text(''.join(f'<http://s/{i}> <http://p> "{i}" .\n' for i in range(0, 50)))
+   (tmp_path / 'b.nt').write_text(''.join(f'<http://s/{i}> <http://p> "{i}" .\n' for i in range(30, 80)))
+   output_file = str(tmp_path / 'merged.nt.gz')
+   stats = ntriples.sort_unique_statements([str(tmp_path / 'a.nt'), str(tmp_path / 'b.nt')], output_file, buffer_size=7)
+   assert stats == {'statements': 80, 'duplicates': 20}
+   statements = list(ntriples.iter_statements(output_file))
+   assert statements == sorted(set(statements)) and len(statements) == 80
+
+def test_iter_file_chunks_compress(tmp_path):
+   content = ''.join(f'<http://s/{i}> <http://p> "{i}" .\n' for i in range(1000)).encode('utf-8')
+   (tmp_path / 'a.nt').write_bytes(content)
+   chunks = list(http_client.iter_file_chunks(str(tmp_path / 'a.nt'), compress=True, chunk_size=1000))
+   assert gzip.decompress(b''.join(chunks)) == content
+   assert b''.join(http_client.iter_file_chunks(str(tmp_path / 'a.nt'), chunk_size=1000)) == content
+
+def test_hcls_stats_from_file(tmp_path):
+   (tmp_path / 'a.nt').write_text('''<http://e/a> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://e/Drug> .
+<http://e/a> <http://e/target> <http://e/t1> .
+<http://e/a> <http://e/name> "aspirin" .
+<http://e/b> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://e/Drug> .
+<http://e/b> <http://e/target> <http://e/t1> .
+<http://e/b> <http://e/name> "aspirin" .
+<http://e/t1> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://e/Protein> .
+''')
+   stats = hcls_stats.compute_hcls_stats([str(tmp_path / 'a.nt')])
+   assert (stats['triples'], stats['entities'], stats['distinctSubjects'], stats['properties']) == (7, 3, 3, 3)
+   assert (stats['distinctObjects'], stats['distinctLiterals'], stats['distinctClasses']) == (3, 1, 2)
+   assert sorted(stats['subjectObjectClasses'].values()) == [(2, 1)]
+   g = hcls_stats.generate_hcls_from_files([str(tmp_path / 'a.nt')], 'http://e/graph')
+   assert len(g) > 0
+
+def test_iter_sparql_triples(monkeypatch):
+   g = generate_metadata.Graph().parse(data=''.join(f'<http://s/{i}> <http://p/{i % 3}> "{i}" .\n<http://s/{i}> a <http://C> .\n' for i in range(25)), format='turtle')
+   queries = []
+   def stub_select(sparql_endpoint, query):
+      queries.append(query)
+      return [dict((str(var), { 'type': 'uri' if isinstance(row[var], generate_metadata.URIRef) else 'literal', 'value': str(row[var]) })
+         for var in row.labels) for row in g.query(query)]
+   monkeypatch.setattr(hcls_stats, 'sparql_select', stub_select)
+   triples = list(hcls_stats.iter_sparql_triples('http://endpoint/sparql', page_size=4))
+   assert len(triples) == len(set(triples)) == 50
+   assert all('ORDER BY' in query for query in queries[1:])
+   assert len(list(hcls_stats.iter_sparql_triples('http://endpoint/sparql', page_size=4, types_only=True))) == 25
+
+def test_hyperloglog_estimate():
+   sketch = hyperloglog.new_sketch(0.02)
+   other = hyperloglog.new_sketch(0.02)
+   for i in range(20000):
+      hyperloglog.add_hash(sketch if i % 2 else other, hyperloglog.hash_term(f'<http://s/{i}>'))
+   hyperloglog.merge_sketches(sketch, other)
+   assert hyperloglog.sketch_error(sketch) <= 0.02
+   assert abs(hyperloglog.estimate_count(sketch) - 20000) < 20000 * 0.02 * 4
+
+def test_split_hcls_query():
+   with open('d2s/queries/hcls/2_3_count_instances_linked_to_property.rq') as f:
+      sparql_query = f.read()
+   assert generate_metadata.get_group_by_variables(sparql_query) == ['?p', '?stype']
+   assert generate_metadata.get_split_variable(sparql_query, 'class') == '?stype'
+   restricted_query = generate_metadata.restrict_query(sparql_query, '?p', 'http://p')
+   assert 'SELECT (COUNT(DISTINCT ?s) AS ?scount) ?stype ?p (COUNT(?p) AS ?triples) \n    { VALUES ?p { <http://p> } ' in restricted_query
+   assert 'GROUP BY ?p ?stype ORDER BY ?p ?stype LIMIT 100 OFFSET 200' in generate_metadata.page_query(sparql_query, 100, 200)
+
+def test_metadata_cache(tmp_path):
+   db = metadata_cache.open_metadata_cache(str(tmp_path / 'cache.sqlite'))
+   metadata_cache.store_results(db, 'http://endpoint', 'http://graph', 'query 1', 'triples=10', [b'<a> <b> <c> .'])
+   assert metadata_cache.get_cached_results(db, 'http://endpoint', 'http://graph', 'query 1', 'triples=10') == ['<a> <b> <c> .']
+   assert metadata_cache.get_cached_results(db, 'http://endpoint', 'http://graph', 'query 1', 'triples=11') is None
+   # The least recently used results are evicted when the cache is too big
+   metadata_cache.store_results(db, 'http://endpoint', 'http://graph', 'query 2', 'triples=10', ['x' * 100], max_size=120)
+   assert metadata_cache.get_cached_results(db, 'http://endpoint', 'http://graph', 'query 1', 'triples=10') is None
+   assert metadata_cache.get_cached_results(db, 'http://endpoint', 'http://graph', 'query 2', 'triples=10') == ['x' * 100]
+
+def test_remove_graph_metadata(tmp_path):
+   (tmp_path / 'a.nt').write_text('<http://e/a> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://e/Drug> .\n')
+   g = hcls_stats.generate_hcls_from_files([str(tmp_path / 'a.nt')], 'http://e/graph1')
+   g = hcls_stats.generate_hcls_from_files([str(tmp_path / 'a.nt')], 'http://e/graph2', g)
+   graph1_size = len(g)
+   generate_metadata.remove_graph_metadata(g, 'http://e/graph2')
+   assert len(g) == graph1_size / 2
+   assert (generate_metadata.URIRef('http://e/graph2'), None, None) not in g
+
+def test_list_graphs_from_file(tmp_path):
+   (tmp_path / 'graphs.txt').write_text('# Graphs to analyze\nhttp://bio2rdf.org/drugbank_resource:bio2rdf.dataset.drugbank.R5\n\nhttp://www.openlinksw.com/schemas/virtrdf#\n')
+   graphs = graph_discovery.list_graphs(None, 'file:' + str(tmp_path / 'graphs.txt'))
+   assert len(graphs) == 2
+   graphs = generate_metadata.get_graphs_to_analyze(None, None, 'file:' + str(tmp_path / 'graphs.txt'), graph_discovery.BIO2RDF_GRAPHS_FILTER)
+   assert graphs == ['http://bio2rdf.org/drugbank_resource:bio2rdf.dataset.drugbank.R5']
+   assert generate_metadata.get_graphs_to_analyze(None, ['http://e/g1', 'http://e/g2'], graphs_filter='g2$') == ['http://e/g2']
+
+def test_analyze_concurrency_order(tmp_path, monkeypatch):
+   def delayed_construct(sparql_endpoint, query):
+      query_hash = hashlib.sha1(query.encode('utf-8')).hexdigest()
+      # The first queries sent complete last
+      time.sleep(int(query_hash[:2], 16) / 255 * 0.05)
+      return '<http://e/result/' + query_hash + '> <http://e/query> "' + query_hash + '" .'
+   monkeypatch.setattr(generate_metadata, 'sparql_construct', delayed_construct)
+   (tmp_path / 'graphs.txt').write_text('http://e/graph1\nhttp://e/graph2\n')
+   runner = CliRunner()
+   for concurrency in ['1', '4']:
+      result = runner.invoke(d2s.cli, ['metadata', 'analyze', 'http://endpoint/sparql', '--graphs-source', 'file:' + str(tmp_path / 'graphs.txt'),
+         '--no-cache', '--stream', 'nt', '-c', concurrency, '-o', str(tmp_path / ('metadata-' + concurrency + '.nt'))])
+      assert result.exit_code == 0
+   output = (tmp_path / 'metadata-1.nt').read_text()
+   assert len(output.splitlines()) == 2 * len(os.listdir(os.path.join(os.path.dirname(generate_metadata.__file__), 'queries', 'hcls')))
+   assert (tmp_path / 'metadata-4.nt').read_text() == output
+
+def test_update_hcls_failed_graph(tmp_path, monkeypatch):
+   monkeypatch.setenv('HOME', str(tmp_path))
+   select_queries = []
+   def stub_select(sparql_endpoint, query):
+      select_queries.append(query)
+      return [{ 'triples': { 'value': '42' } }] if 'COUNT(*)' in query else []
+   def stub_construct(sparql_endpoint, query):
+      if 'http://e/graph2' in query:
+         raise Exception('timeout')
+      return '<http://e/graph1> <http://rdfs.org/ns/void#triples> 42 .'
+   monkeypatch.setattr(generate_metadata, 'sparql_select', stub_select)
+   monkeypatch.setattr(generate_metadata, 'sparql_construct', stub_construct)
+   metadata_file = str(tmp_path / 'metadata.ttl')
+   generate_metadata.update_hcls_from_sparql('http://endpoint/sparql', metadata_file, ['http://e/graph1', 'http://e/graph2'], split='none')
+   # The fingerprints are only queried once per graph, and the graph with failed queries is not indexed
+   assert len(select_queries) == 4
+   with open(metadata_file + generate_metadata.METADATA_INDEX_SUFFIX) as f:
+      assert list(json.load(f)['graphs'].keys()) == ['http://e/graph1']
+   try:
+      generate_metadata.generate_hcls_from_sparql('http://endpoint/sparql', None, 'hcls', ['http://e/graph2'], cache=False, split='none')
+      assert False
+   except Exception as e:
+      assert 'http://e/graph2' in str(e)
+
+def test_write_metadata_stream(tmp_path):
+   (tmp_path / 'a.nt').write_text('<http://e/a> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://e/Drug> .\n')
+   g = hcls_stats.generate_hcls_from_files([str(tmp_path / 'a.nt')], 'http://e/graph1')
+   with generate_metadata.open_metadata_stream(str(tmp_path / 'metadata'), 'http://e/graph1', 'nq') as f:
+      generate_metadata.write_metadata_stream(f, g, 'http://e/graph1', 'nq')
+   graph_file = tmp_path / 'metadata' / (generate_metadata.get_graph_file_name('http://e/graph1') + '.nq')
+   lines = graph_file.read_text().splitlines()
+   assert len(lines) == len(g)
+   assert all(line.endswith(' <http://e/graph1> .') for line in lines)
+
+def test_metadata_journal(tmp_path):
+   journal_file = str(tmp_path / 'metadata.ttl') + defaults.METADATA_JOURNAL_SUFFIX
+   with open(journal_file, 'w') as journal:
+      metadata_cache.write_journal_entry(journal, 'http://endpoint', 'http://graph', 'query 1', [b'<a> <b> <c> .'])
+      metadata_cache.write_journal_entry(journal, 'http://other', 'http://graph', 'query 2', ['<a> <b> <d> .'])
+      # Entry partially written before a crash
+      journal.write('{"endpoint": "http://endpoint", "graph"')
+   journal_index = metadata_cache.read_journal(journal_file, 'http://endpoint')
+   assert list(journal_index.keys()) == [('http://graph', metadata_cache.get_query_hash('query 1'))]
+   assert metadata_cache.get_journal_results(journal_file, journal_index[('http://graph', metadata_cache.get_query_hash('query 1'))]) == ['<a> <b> <c> .']
+   assert open(journal_file).read().endswith('\n')
+
+def test_query_log(tmp_path, capsys):
+   results, start_time, wall_time, error = query_log.timed(int, '42')
+   assert results == 42 and wall_time >= 0 and error is None
+   results, start_time, wall_time, error = query_log.timed(int, 'not a number')
+   assert results is None and isinstance(error, ValueError)
+   log_file = str(tmp_path / 'queries.jsonl')
+   with query_log.open_query_log(log_file) as f:
+      query_log.log_query(f, {'graph': 'http://e/g', 'query': '1_1_count_triples.rq', 'status': 'success', 'wall_time': 1.5, 'bytes': 100, 'triples': 2})
+      query_log.log_query(f, {'graph': 'http://e/g', 'query': '2_1_count_properties.rq', 'status': 'failed', 'wall_time': 30.0, 'bytes': 0, 'triples': 0})
+   query_log.print_slowest_queries(query_log.read_query_log(log_file))
+   output = capsys.readouterr().out
+   assert output.index('2_1_count_properties.rq') < output.index('1_1_count_triples.rq')
+
+def test_sparql_client_settings():
+   sparql_client.configure_sparql_client(read_timeout=60, retries=None)
+   assert sparql_client.SPARQL_CLIENT_SETTINGS['read_timeout'] == 60
+   assert sparql_client.SPARQL_CLIENT_SETTINGS['retries'] == 3
+   assert sparql_client.get_endpoint_semaphore('http://endpoint') is sparql_client.get_endpoint_semaphore('http://endpoint')
+   try:
+      sparql_client.configure_sparql_client(timeout=60)
+      assert False
+   except Exception as e:
+      assert 'Invalid SPARQL client setting' in str(e)
+   sparql_client.configure_sparql_client(read_timeout=600)
+
+def test_sparql_insert_files_failures(tmp_path):
+   (tmp_path / 'invalid.ttl').write_text('<http://e/a> <http://e/p> .\n')
+   failed_files = sparql_operations.sparql_insert_files(str(tmp_path / '*.ttl'), 'http://127.0.0.1:1/statements', 'dba', 'dba', workers=2)
+   assert list(failed_files.keys()) == [str(tmp_path / 'invalid.ttl')]
+
+def test_insert_ntriples_blank_nodes(tmp_path, monkeypatch):
+   requests_sent = []
+   monkeypatch.setattr(sparql_operations, 'post_rdf', lambda sparql_endpoint, data, mimetype, auth, params, body_factory:
+      requests_sent.append(data if body_factory is None else b''.join(body_factory())))
+   (tmp_path / 'a.nt').write_text(''.join(f'<http://s/{i}> <http://p> "{i}" .\n' for i in range(5)))
+   assert sparql_operations.insert_ntriples_file_in_sparql_endpoint(str(tmp_path / 'a.nt'), 'http://e/statements', 'dba', 'dba', chunks_size=2)['chunks'] == 3
+   # The statements of a blank node in different chunks would be inserted as different nodes
+   (tmp_path / 'b.nt').write_text('_:b0 <http://p> "0" .\n<http://s/1> <http://p> "1" .\n_:b0 <http://p> "2" .\n')
+   requests_sent.clear()
+   assert sparql_operations.insert_ntriples_file_in_sparql_endpoint(str(tmp_path / 'b.nt'), 'http://e/statements', 'dba', 'dba', chunks_size=2) == { 'statements': 3, 'chunks': 1 }
+   assert requests_sent == [(tmp_path / 'b.nt').read_bytes()]
+
+def test_instance_sync_changes():
+   old_g = generate_metadata.Graph().parse(data='<http://e/a> <http://e/name> "A" ; <http://e/age> 1 ; <http://e/addr> [ <http://e/city> "Paris" ] .', format='turtle')
+   new_g = generate_metadata.Graph().parse(data='<http://e/a> <http://e/name> "A" ; <http://e/age> 2 ; <http://e/addr> [ <http://e/city> "Paris" ] .', format='turtle')
+   subject = generate_metadata.URIRef('http://e/a')
+   # Blank nodes labels do not change the hash
+   assert instance_sync.hash_description(instance_sync.get_description(old_g, subject)) == instance_sync.hash_description(instance_sync.get_description(generate_metadata.Graph().parse(data=old_g.serialize(format='nt'), format='nt'), subject))
+   changes = instance_sync.get_description_changes(instance_sync.get_description(new_g, subject), instance_sync.get_description(old_g, subject))
+   assert not changes['replace_blank_nodes']
+   assert [str(triple[2]) for triple in changes['delete']] == ['1'] and [str(triple[2]) for triple in changes['insert']] == ['2']
+   update = instance_sync.get_sync_update({subject: changes}, 'http://e/graph')
+   assert update.startswith('DELETE DATA { GRAPH <http://e/graph> {') and 'INSERT DATA' in update
+
+def test_iter_sorted_diff(tmp_path):
+   (tmp_path / 'old.nt').write_text(''.join(f'<http://s/{i}> <http://p> "{i}" .\n' for i in range(0, 50)))
+   (tmp_path / 'new.nt').write_text(''.join(f'<http://s/{i}> <http://p> "{i}" .\n' for i in range(10, 60)))
+   for name in ['old', 'new']:
+      ntriples.sort_unique_statements([str(tmp_path / (name + '.nt'))], str(tmp_path / (name + '.sorted.nt')))
+   changes = list(ntriples.iter_sorted_diff(str(tmp_path / 'old.sorted.nt'), str(tmp_path / 'new.sorted.nt')))
+   assert len([change for change in changes if change[0] == '-']) == 10
+   assert len([change for change in changes if change[0] == '+']) == 10
+   assert ('+', '<http://s/55> <http://p> "55" .') in changes
+   assert ntriples.has_blank_node('_:b1 <http://p> "1" .') and not ntriples.has_blank_node('<http://s/1> <http://p> "1" .')
+
+def test_snapshot_store(tmp_path):
+   snapshots_dir = str(tmp_path / 'snapshots')
+   (tmp_path / 'v1.nt').write_text(''.join(f'<http://s/{i}> <http://p> "{i}" .\n' for i in range(20, 0, -1)))
+   (tmp_path / 'v2.nt').write_text(''.join(f'<http://s/{i}> <http://p> "{i}" .\n' for i in range(5, 25)))
+   first = snapshot_store.create_snapshot('test', [str(tmp_path / 'v1.nt')], snapshots_dir)
+   assert snapshot_store.create_snapshot('test', [str(tmp_path / 'v1.nt')], snapshots_dir)['id'] == first['id']
+   second = snapshot_store.create_snapshot('test', [str(tmp_path / 'v2.nt')], snapshots_dir)
+   assert [snapshot['statements'] for snapshot in snapshot_store.load_snapshots_index('test', snapshots_dir)['snapshots']] == [20, 20]
+   changes = list(snapshot_store.diff_snapshots('test', first['id'], second['id'], snapshots_dir))
+   assert len([change for change in changes if change[0] == '-']) == 4
+   assert ('+', '<http://s/24> <http://p> "24" .') in changes
+   snapshot_store.set_published_snapshot('test', first['id'], snapshots_dir)
+   assert snapshot_store.prune_snapshots('test', 0, snapshots_dir) == [second['id']]
+   snapshot_store.restore_snapshot('test', first['id'], str(tmp_path / 'restored.nt'), snapshots_dir)
+   assert sorted((tmp_path / 'restored.nt').read_text().splitlines()) == sorted((tmp_path / 'v1.nt').read_text().splitlines())
+   # The merged output of d2s run is already sorted, it is only compressed
+   ntriples.sort_unique_statements([str(tmp_path / 'v2.nt')], str(tmp_path / 'merged.nt'))
+   third = snapshot_store.create_snapshot('test', [str(tmp_path / 'merged.nt')], snapshots_dir, presorted=True)
+   assert third['statements'] == 20
+   assert len([change for change in snapshot_store.diff_snapshots('test', first['id'], third['id'], snapshots_dir) if change[0] == '-']) == 4
+
+def test_run_delta_without_snapshots():
+   result = CliRunner().invoke(d2s.cli, ['run', '--publish', '--delta', '--keep-snapshots', '0'])
+   assert result.exit_code == 2
+   assert '--keep-snapshots 0' in result.output
+
+def test_cli_lazy_imports():
+   # Starting d2s (e.g. for --help or shell completion) should not load the commands modules and their heavy dependencies
+   script = ('import sys, time, atexit; start = time.perf_counter(); from d2s.__main__ import cli; '
+      'atexit.register(lambda: print(time.perf_counter() - start, ",".join(sys.modules))); cli(["metadata", "--help"])')
+   startup_time, modules = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True).stdout.splitlines()[-1].split(' ')
+   for heavy_module in ['rdflib', 'pandas', 'SPARQLWrapper', 'git', 'yaml', 'dotenv', 'pkg_resources', 'requests', 'd2s.generate_metadata', 'd2s.process_datasets']:
+      assert heavy_module not in modules.split(','), heavy_module + ' loaded at startup'
+   # Around 0.05s without the heavy modules, requests alone takes about 0.1s to import
+   assert float(startup_time) < 0.25, 'd2s started in ' + startup_time + 's'
+
+def test_project_config(tmp_path):
+   config_file = tmp_path / 'd2s.yml'
+   config_file.write_text(open('d2s/templates/project/d2s.yml').read() + '\nresources:\n  memory: 8g\n  download-workers: 8\n')
+   config = project_config.load_project_config(str(config_file))
+   assert config.staging.sparql_endpoint == 'https://staging-endpoint/sparql'
+   assert config.resources == project_config.ResourcesConfig('8g', 2048, None, 8)
+   assert project_config.load_project_config(str(config_file)) is config
+   errors = project_config.validate_config({ 'production': { 'sparql-endpoint': 'https://endpoint/sparql' }, 'staging': [], 'base-url': 'https://w3id.org/d2s/',
+      'resources': { 'memory': 'lots', 'download-workers': 0 } })
+   assert "production: 'virtuoso-ldp-url' is a required property" in errors
+   assert "staging: [] is not of type 'object'" in errors
+   assert len(errors) == 4